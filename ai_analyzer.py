@@ -1,20 +1,337 @@
 # -*- coding: utf-8 -*-
+import functools
+import hashlib
 import json
 import logging
+import re
+import string
 import asyncio
-from datetime import datetime
-from typing import List, Dict, Any
+import time
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from enum import Enum
+from itertools import accumulate, islice
+from types import MappingProxyType
+from typing import List, Dict, Any, Awaitable, Callable, Iterable, Optional, Sequence, Sized, Tuple
 
 import google.generativeai as genai
+from google.api_core import exceptions as gexc
+from google.generativeai import caching
 from google.generativeai.types import HarmCategory, HarmBlockThreshold 
 from config import Config
 
+try:
+    # orjson заметно быстрее stdlib json на больших ответах Gemini
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+# Настройки безопасности одинаковы для всех запросов — собираем их один раз
+_SAFETY_SETTINGS = MappingProxyType({
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+})
+
+# Дополнение generation_config для JSON-ответов
+_JSON_RESPONSE_CONFIG = MappingProxyType({"response_mime_type": "application/json"})
+
+# Единый формат времени для промптов и подвалов отчётов
+_TS_FMT = "%Y-%m-%d %H:%M"
+
+
+def _fmt_ts(ts: Any) -> str:
+    """Форматирует время сообщения для промпта"""
+    return ts.strftime(_TS_FMT) if hasattr(ts, "strftime") else str(ts)
+
+
+@functools.lru_cache(maxsize=1)
+def _minute_stamp(minute: int) -> str:
+    return datetime.fromtimestamp(minute * 60).strftime(_TS_FMT)
+
+
+def _report_stamp() -> str:
+    """Текущее время для подвала отчёта; strftime выполняется раз в минуту"""
+    return _minute_stamp(int(time.time() // 60))
+
+
+# Сколько последних сообщений и взаимодействий попадает в персональный промпт
+_PERSONAL_PROMPT_MESSAGES = 20
+_PERSONAL_PROMPT_INTERACTIONS = 5
+
+
+def _tail(items: Iterable[Any], n: int) -> Sequence[Any]:
+    """
+    Последние n элементов: срез для list/tuple, islice с известной длиной
+    для остальных коллекций (deque не поддерживает срезы), deque(maxlen) для итераторов
+    """
+    if isinstance(items, (list, tuple)):
+        return items[-n:]
+    if isinstance(items, Sized):
+        return list(islice(items, max(0, len(items) - n), None))
+    return deque(items, maxlen=n)
+
+
+class _PromptTemplate:
+    """Шаблон промпта, разобранный один раз: подстановка — это только join"""
+
+    __slots__ = ("_parts",)
+
+    def __init__(self, template: str):
+        self._parts = tuple(
+            (literal, field) for literal, field, _, _ in string.Formatter().parse(template)
+        )
+
+    def render(self, **values: Any) -> str:
+        return "".join(
+            literal if field is None else f"{literal}{values[field]}"
+            for literal, field in self._parts
+        )
+
+
+_GROUP_USER_PROMPT = _PromptTemplate(Config.GROUP_ANALYSIS_USER_PROMPT_TEMPLATE)
+_PERSONAL_USER_PROMPT = _PromptTemplate(Config.PERSONAL_ANALYSIS_USER_PROMPT_TEMPLATE)
+
+
+# Каркас группового отчёта; секции со списками подставляются готовыми блоками
+_GROUP_REPORT_TEMPLATE = (
+    "📊 *Анализ коммуникаций*\n\n"
+    "📝 Проанализировано сообщений: {message_count}\n\n"
+    "{omitted_note}"
+    "🎯 *Тон общения:* {tone}\n\n"
+    "📈 *Эффективность:* {score}/10\n\n"
+    "🌍 *Атмосфера в команде:* {atmosphere}\n"
+    "{positive}{improvements}{recommendations}"
+    "\n\n---\n📅 Анализ выполнен: {when}"
+)
+
+# (поле шаблона, ключ в ответе AI, заголовок секции)
+_GROUP_REPORT_SECTIONS = (
+    ("positive", "positive_patterns", "\n✅ *Позитивные паттерны:*"),
+    ("improvements", "improvement_areas", "\n\n⚠️ *Области для улучшения:*"),
+    ("recommendations", "recommendations", "\n\n💡 *Рекомендации:*"),
+)
+
+
+_MD_SPECIAL_RE = re.compile(r'([_*`\[])')
+
+
+def escape_markdown(value: Any) -> str:
+    """
+    Экранирует текст от AI, имена и названия чатов для Markdown Telegram: один лишний
+    "_" или "*" ломает разбор всего отчёта, и его приходится пересылать без разметки.
+    Все строки, которые возвращают методы analyze_*, уже экранированы
+    """
+    return _MD_SPECIAL_RE.sub(r'\\\1', str(value))
+
+
+def _bullet_section(heading: str, items: List[Any]) -> str:
+    """Секция отчёта: заголовок и маркированный список, либо пустая строка"""
+    if not items:
+        return ""
+    return heading + "".join(f"\n• {escape_markdown(item)}" for item in items)
+
+
+# Грубая оценка размера промпта: символов на токен (кириллица токенизируется плотнее латиницы)
+_CHARS_PER_TOKEN = 3
+# Длина "[YYYY-MM-DD HH:MM] " + ": " + перевод строки в каждой строке транскрипта
+_LINE_OVERHEAD = 22
+
+# Лимит текстового ответа растёт с числом сообщений: половина лимита вида анализа
+# (в него входят и "thinking"-токены Gemini 2.5) плюс запас на сообщение.
+# К JSON-видам не применяется — они всегда получают полный max_tokens
+_OUTPUT_TOKENS_PER_MESSAGE = 8
+_OUTPUT_TOKENS_STEP = 256
+
+
+def _adaptive_max_tokens(limit: int, message_count: int) -> int:
+    """max_output_tokens под размер окна, округлённый вверх до _OUTPUT_TOKENS_STEP"""
+    wanted = limit // 2 + _OUTPUT_TOKENS_PER_MESSAGE * message_count
+    rounded = -(-wanted // _OUTPUT_TOKENS_STEP) * _OUTPUT_TOKENS_STEP
+    return min(limit, rounded)
+
+
+# С какого числа строк промпт собирается в отдельном потоке: меньшие
+# объёмы дешевле отформатировать сразу, чем платить за переключение потоков
+_OFFLOAD_MIN_LINES = 200
+
+# Сообщения с текстом не длиннее этого считаются несодержательными
+_MIN_MEANINGFUL_CHARS = 3
+_NOT_ENOUGH_MESSAGES = "❌ Недостаточно содержательных сообщений для анализа."
+
+# Кеш готовых отчётов: сколько хранить и как долго (секунды)
+_REPORT_CACHE_SIZE = 256
+_REPORT_CACHE_TTL = 600
+
+# Сколько первых сообщений длинной истории сохраняется для контекста
+_WINDOW_HEAD_MESSAGES = 50
+
+# Максимальное количество закешированных экземпляров GenerativeModel
+_MODEL_CACHE_SIZE = 16
+
+# Короткие промпты не проходят минимальный размер explicit context cache Gemini
+_CONTEXT_CACHE_MIN_CHARS = 4096
+# Пересоздаём серверный кеш немного раньше истечения TTL
+_CONTEXT_CACHE_REFRESH_MARGIN = 60
+
+
+class AnalysisKind(Enum):
+    """Виды анализа, которые умеет делать бот"""
+    GROUP = "group"
+    PERSONAL = "personal"
+    CONFLICT = "conflict"
+    TIPS = "tips"
+
+
+@dataclass(frozen=True, slots=True)
+class AnalyzerSpec:
+    """Параметры запроса к Gemini для конкретного вида анализа"""
+    system_prompt: str
+    temperature: float
+    max_tokens: int
+    response_json: bool
+    stream: bool = False
+
+
+_ANALYZER_SPECS: Dict[AnalysisKind, AnalyzerSpec] = {
+    AnalysisKind.GROUP: AnalyzerSpec(
+        system_prompt=Config.GROUP_ANALYSIS_SYSTEM_PROMPT,
+        temperature=0.4, max_tokens=3000, response_json=True, stream=True,
+    ),
+    AnalysisKind.PERSONAL: AnalyzerSpec(
+        system_prompt=Config.PERSONAL_ANALYSIS_SYSTEM_PROMPT,
+        temperature=0.4, max_tokens=3500, response_json=True, stream=True,
+    ),
+    AnalysisKind.CONFLICT: AnalyzerSpec(
+        system_prompt=Config.CONFLICT_ANALYSIS_SYSTEM_PROMPT,
+        temperature=0.3, max_tokens=2000, response_json=False,
+    ),
+    AnalysisKind.TIPS: AnalyzerSpec(
+        system_prompt=Config.TIPS_ANALYSIS_SYSTEM_PROMPT,
+        temperature=0.3, max_tokens=2000, response_json=False,
+    ),
+}
+
+# Пользовательские промпты текстовых отчётов; {} — транскрипт переписки
+_TEXT_REPORT_PROMPTS: Dict[AnalysisKind, str] = {
+    AnalysisKind.CONFLICT: "Вот диалог:\n{}\n\nОпиши структуру конфликта.",
+    AnalysisKind.TIPS: "Вот переписка:\n{}\n\nВыдели полезные советы и идеи.",
+}
+
+
+class PromptCache:
+    """LRU-кеш ответов Gemini с точным совпадением промпта (с необязательным TTL)"""
+
+    def __init__(self, max_size: int = 128, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, str]" = OrderedDict()
+        self._expires: Dict[bytes, float] = {}
+
+    @staticmethod
+    def make_key(*parts: Any) -> bytes:
+        """Строит ключ кеша из параметров запроса"""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            digest.update(repr(part).encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        value = self._entries.get(key)
+        if value is None:
+            return None
+        if self.ttl is not None and self._expires[key] <= time.monotonic():
+            del self._entries[key], self._expires[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: bytes, value: str):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if self.ttl is not None:
+            self._expires[key] = time.monotonic() + self.ttl
+        if len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            self._expires.pop(evicted, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _similarity_scope(messages: List[Dict[str, Any]], per_user: bool = False) -> Optional[tuple]:
+    """
+    Чаты (и для персонального анализа — пользователи), из которых построен промпт.
+    None, если у сообщений нет chat_id: тогда кеш похожих запросов не используется
+    """
+    chat_ids = {msg.get('chat_id') for msg in messages}
+    if not chat_ids or None in chat_ids:
+        return None
+    if not per_user:
+        return tuple(sorted(chat_ids))
+    user_ids = {msg.get('user_id') for msg in messages}
+    if None in user_ids:
+        return None
+    return tuple(sorted(chat_ids)), tuple(sorted(user_ids))
+
+
+class SimilarPromptCache:
+    """
+    Кеш ответов для почти совпадающих промптов.
+    Промпт сравнивается как множество строк (коэффициент Жаккара): повторный
+    анализ того же окна с парой новых сообщений получает сохранённый ответ.
+    """
+
+    def __init__(self, max_size: int = 32, threshold: float = 0.92, ttl: float = 3600):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        # (namespace, строки промпта, ответ, monotonic-время истечения)
+        self._entries: "deque[Tuple[bytes, frozenset, str, float]]" = deque(maxlen=max_size)
+
+    @staticmethod
+    def _shingles(prompt: str) -> frozenset:
+        return frozenset(line for line in prompt.split("\n") if line.strip())
+
+    def get(self, namespace: bytes, prompt: str) -> Optional[str]:
+        if self.threshold <= 0:
+            return None
+        lines = self._shingles(prompt)
+        if not lines:
+            return None
+        now = time.monotonic()
+        best, best_score = None, self.threshold
+        for entry_ns, entry_lines, value, expires_at in self._entries:
+            if entry_ns != namespace or expires_at <= now:
+                continue
+            score = len(lines & entry_lines) / len(lines | entry_lines)
+            if score >= best_score:
+                best, best_score = value, score
+        return best
+
+    def put(self, namespace: bytes, prompt: str, value: str):
+        if self.threshold <= 0:
+            return
+        self._entries.append((namespace, self._shingles(prompt), value, time.monotonic() + self.ttl))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
 
 class CommunicationAnalyzer:
     """AI-powered communication analyzer using Google Gemini API"""
 
+    # Общие для всех экземпляров context caches Gemini:
+    # хеш (модель, системный промпт) -> (CachedContent или None, monotonic-время продления)
+    _context_caches: Dict[str, Tuple[Optional[caching.CachedContent], float]] = {}
+
     def __init__(self):
         # ✅ ИСПРАВЛЕНО: не делаем сетевые вызовы в __init__
         # Раньше genai.list_models() вызывался здесь и мог уронить весь бот при старте,
@@ -30,82 +347,311 @@ class CommunicationAnalyzer:
         # Устанавливаем модель
         self.model_name = "models/gemini-2.5-flash"
 
+        # LRU-кеш моделей по (model_name, system_prompt), чтобы не создавать
+        # GenerativeModel заново на каждый запрос
+        self._model_cache: "OrderedDict[tuple, genai.GenerativeModel]" = OrderedDict()
+
+        # Список моделей запрашивается лениво и только один раз
+        self._available_models: Optional[List[str]] = None
+        self._models_lock = asyncio.Lock()
+
+        # Выполняющиеся запросы к Gemini и сборки отчётов по ключу
+        self._inflight: Dict[bytes, "asyncio.Future[str]"] = {}
+
+        # Кеш ответов: повторный анализ того же окна сообщений не идёт в API
+        self._prompt_cache = PromptCache(max_size=Config.PROMPT_CACHE_SIZE)
+        # Готовые отчёты по содержимому окна: повторный /analyze без новых
+        # сообщений не форматирует и не разбирает ответ заново
+        self._report_cache = PromptCache(max_size=_REPORT_CACHE_SIZE, ttl=_REPORT_CACHE_TTL)
+        self._similar_cache = SimilarPromptCache(
+            max_size=Config.SIMILAR_CACHE_SIZE,
+            threshold=Config.SIMILAR_CACHE_THRESHOLD,
+            ttl=Config.SIMILAR_CACHE_TTL,
+        )
+
+    def _get_model(self, system_prompt: str, cached_content: Optional[str] = None) -> genai.GenerativeModel:
+        """Возвращает закешированную модель для системного промпта или создаёт новую."""
+        key = (self.model_name, system_prompt, cached_content)
+        model = self._model_cache.get(key)
+        if model is not None:
+            self._model_cache.move_to_end(key)
+            return model
+
+        if cached_content:
+            # Системный промпт уже лежит на стороне Gemini
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=cached_content,
+                safety_settings=_SAFETY_SETTINGS
+            )
+        else:
+            model = genai.GenerativeModel(
+                model_name=self.model_name,
+                system_instruction=system_prompt,
+                safety_settings=_SAFETY_SETTINGS
+            )
+        self._model_cache[key] = model
+        if len(self._model_cache) > _MODEL_CACHE_SIZE:
+            self._model_cache.popitem(last=False)
+        return model
+
+    async def _get_context_cache(self, system_prompt: str) -> Optional[str]:
+        """
+        Возвращает имя explicit context cache Gemini для системного промпта.
+        Кеш создаётся лениво при первом использовании; перед истечением TTL
+        он продлевается, а пересоздаётся, только если продлить не удалось.
+        """
+        if not Config.GEMINI_CONTEXT_CACHE or len(system_prompt) < _CONTEXT_CACHE_MIN_CHARS:
+            return None
+
+        key = PromptCache.make_key(self.model_name, system_prompt).hex()
+        now = time.monotonic()
+        cached, refresh_at = self._context_caches.get(key, (None, 0.0))
+        if refresh_at > now:
+            return cached.name if cached else None
+
+        ttl = Config.GEMINI_CONTEXT_CACHE_TTL
+        refresh_at = now + max(ttl - _CONTEXT_CACHE_REFRESH_MARGIN, 0)
+
+        if cached is not None:
+            try:
+                await asyncio.to_thread(cached.update, ttl=timedelta(seconds=ttl))
+                self._context_caches[key] = (cached, refresh_at)
+                return cached.name
+            except Exception as e:
+                logger.warning(f"Не удалось продлить context cache Gemini {cached.name}: {e}")
+
+        try:
+            cached = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=self.model_name,
+                system_instruction=system_prompt,
+                ttl=timedelta(seconds=ttl),
+            )
+        except Exception as e:
+            # Не повторяем попытку до следующего окна TTL — работаем без кеша
+            logger.warning(f"Не удалось создать context cache Gemini: {e}")
+            self._context_caches[key] = (None, refresh_at)
+            return None
+
+        logger.info(f"Создан context cache Gemini: {cached.name}")
+        self._context_caches[key] = (cached, refresh_at)
+        return cached.name
+
     async def _call_gemini(self, system_prompt: str, user_prompt: str, 
                            temperature: float = 0.4, max_tokens: int = 3000, 
-                           response_json: bool = True) -> str:
+                           response_json: bool = True, stream: bool = False,
+                           scope: Optional[tuple] = None) -> str:
         """
         Вспомогательный метод для вызова Gemini API асинхронно.
+
+        При stream=True ответ читается по частям; для JSON-ответа чтение
+        прекращается сразу, если первый фрагмент не похож на JSON.
+        scope — чаты и пользователи, по которым построен промпт (_similarity_scope):
+        похожий ответ берётся только из того же scope, без scope кеш похожих не используется.
         """
         # ✅ Проверяем ключ перед каждым вызовом
         if not Config.GEMINI_API_KEY:
             return "❌ GEMINI_API_KEY не задан. Добавьте его в настройках Vercel → Settings → Environment Variables."
 
+        cache_key = PromptCache.make_key(
+            self.model_name, system_prompt, user_prompt, temperature, max_tokens, response_json
+        )
+        cached = self._prompt_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Ответ Gemini взят из кеша")
+            return cached
+
+        # max_tokens в пространство имён не входит: он растёт с размером окна.
+        # scope входит: отчёт по одному чату никогда не отдаётся другому
+        namespace = None
+        if scope is not None:
+            namespace = PromptCache.make_key(self.model_name, system_prompt, temperature, response_json, scope)
+            cached = self._similar_cache.get(namespace, user_prompt)
+            if cached is not None:
+                logger.info("Ответ Gemini взят из кеша похожих запросов")
+                return cached
+
+        # ✅ Одинаковые запросы, пришедшие одновременно, разделяют один вызов API
+        return await self._run_shared(cache_key, lambda: self._request_gemini(
+            cache_key, system_prompt, user_prompt,
+            temperature, max_tokens, response_json, stream, namespace,
+        ))
+
+    async def _run_shared(self, key: bytes, make_coro: Callable[[], Awaitable[str]]) -> str:
+        """Одна задача на ключ: одновременные вызовы с тем же ключом ждут её результат"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_coro())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            logger.info("Ожидаем уже выполняющийся идентичный запрос")
+        # shield: отмена одного из ожидающих не должна обрывать запрос остальным
+        return await asyncio.shield(task)
+
+    async def _request_gemini(self, cache_key: bytes, system_prompt: str, user_prompt: str,
+                              temperature: float, max_tokens: int,
+                              response_json: bool, stream: bool,
+                              similar_namespace: Optional[bytes] = None) -> str:
+        """Выполняет сам запрос к Gemini и кладёт удачный ответ в кеш"""
         try:
-            from google.generativeai.types import HarmCategory, HarmBlockThreshold
-            
-            safety_settings = {
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-            }
-            
-            model = genai.GenerativeModel(
-                model_name=self.model_name,
-                system_instruction=system_prompt,
-                safety_settings=safety_settings
-            )
+            cached_content = await self._get_context_cache(system_prompt)
+            model = self._get_model(system_prompt, cached_content)
 
             generation_config = {
                 "temperature": temperature,
                 "max_output_tokens": max_tokens,
+                **(_JSON_RESPONSE_CONFIG if response_json else {}),
             }
-            if response_json:
-                generation_config["response_mime_type"] = "application/json"
-
-            # ✅ Запускаем синхронный вызов в отдельном потоке (правильный способ для async)
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: model.generate_content(
+
+            # ✅ Нативный асинхронный вызов SDK — без пула потоков
+            if stream:
+                response, text = await self._generate_streamed(
+                    model, user_prompt, generation_config, response_json
+                )
+            else:
+                response = await model.generate_content_async(
                     user_prompt,
                     generation_config=generation_config,
                 )
-            )
+                text = None
 
             if response.prompt_feedback and response.prompt_feedback.block_reason:
                 block_reason = response.prompt_feedback.block_reason
                 logger.warning(f"Запрос заблокирован: {block_reason}")
-                return f"⚠️ Запрос заблокирован API: {block_reason}. Попробуйте смягчить формулировки."
+                return f"⚠️ Запрос заблокирован API: {escape_markdown(block_reason)}. Попробуйте смягчить формулировки."
 
-            return response.text
+            if text is None:
+                text = response.text
+            if self._is_cacheable(text, response_json):
+                self._prompt_cache.put(cache_key, text)
+                if similar_namespace is not None:
+                    self._similar_cache.put(similar_namespace, user_prompt, text)
+            return text
             
-        except Exception as e:
+        except gexc.NotFound as e:
+            logger.error(f"Gemini model not found: {e}")
+            return "❌ Модель не найдена. Проверьте правильность имени модели."
+        except (gexc.Unauthenticated, gexc.PermissionDenied) as e:
+            logger.error(f"Gemini rejected API key: {e}")
+            return "❌ Неверный GEMINI_API_KEY. Проверьте ключ в настройках Vercel."
+        except (gexc.ResourceExhausted, gexc.TooManyRequests) as e:
+            logger.error(f"Gemini quota exceeded: {e}")
+            return "❌ Превышен лимит запросов к API. Подождите немного."
+        except gexc.InvalidArgument as e:
             logger.error(f"Gemini API call failed: {e}")
-            
-            error_message = str(e)
-            if "404" in error_message and "model" in error_message:
-                return "❌ Модель не найдена. Проверьте правильность имени модели."
-            elif "API key" in error_message or "401" in error_message:
+            # Неверный ключ Gemini возвращает 400 INVALID_ARGUMENT, а не 401
+            if "API key" in str(e):
                 return "❌ Неверный GEMINI_API_KEY. Проверьте ключ в настройках Vercel."
-            elif "quota" in error_message.lower() or "rate limit" in error_message.lower() or "429" in error_message:
-                return "❌ Превышен лимит запросов к API. Подождите немного."
-            else:
-                return f"❌ Ошибка при обращении к AI: {error_message[:200]}"
+            return f"❌ Ошибка при обращении к AI: {escape_markdown(str(e)[:200])}"
+        except Exception as e:
+            logger.error(f"Gemini API call failed: {e}")
+            return f"❌ Ошибка при обращении к AI: {escape_markdown(str(e)[:200])}"
 
-    async def check_available_models(self):
-        """Проверить, какие модели доступны"""
+    async def _call_spec(self, kind: "AnalysisKind", user_prompt: str,
+                         message_count: Optional[int] = None, scope: Optional[tuple] = None) -> str:
+        """Вызов Gemini с параметрами, заранее заданными для вида анализа"""
+        spec = _ANALYZER_SPECS[kind]
+        max_tokens = spec.max_tokens
+        # JSON-отчёты получают полный лимит: обрезанный на середине объект не разобрать
+        if message_count is not None and not spec.response_json:
+            max_tokens = _adaptive_max_tokens(spec.max_tokens, message_count)
+        return await self._call_gemini(
+            spec.system_prompt,
+            user_prompt,
+            spec.temperature,
+            max_tokens,
+            spec.response_json,
+            spec.stream,
+            scope,
+        )
+
+    @staticmethod
+    async def _generate_streamed(model: genai.GenerativeModel, user_prompt: str,
+                                 generation_config: Dict[str, Any], response_json: bool):
+        """Читает потоковый ответ Gemini"""
+        response = await model.generate_content_async(
+            user_prompt,
+            generation_config=generation_config,
+            stream=True,
+        )
+        chunks: List[str] = []
+        stream = response.__aiter__()
         try:
-            models = genai.list_models()
-            available = []
-            for m in models:
-                if 'generateContent' in m.supported_generation_methods:
-                    available.append(m.name)
-            logger.info(f"Доступные модели: {available}")
-            return available
-        except Exception as e:
-            logger.error(f"Ошибка при получении списка моделей: {e}")
-            return []
+            async for chunk in stream:
+                try:
+                    piece = chunk.text
+                except ValueError:
+                    # Фрагмент без текста (например, служебный финальный)
+                    continue
+                if response_json and not chunks and piece.strip() and piece.lstrip()[0] not in "{[":
+                    # Модель ответила не JSON — дальше читать бессмысленно
+                    logger.warning("Gemini вернул не-JSON ответ, чтение потока прервано")
+                    chunks.append(piece)
+                    break
+                chunks.append(piece)
+        finally:
+            # После break поток gRPC остался бы открытым до сборки мусора — закрываем
+            # сами итератор, который читали; aclose есть не у любого async-итератора
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        return response, "".join(chunks)
+
+    @staticmethod
+    def _is_cacheable(text: str, response_json: bool) -> bool:
+        """Кешируем только непустые ответы, а JSON — только если он корректный"""
+        if not text:
+            return False
+        if response_json:
+            try:
+                _json_loads(text)
+            except json.JSONDecodeError:
+                return False
+        return True
+
+    async def check_available_models(self) -> List[str]:
+        """Проверить, какие модели доступны (результат запоминается)"""
+        async with self._models_lock:
+            if self._available_models is not None:
+                return self._available_models
+            try:
+                # list_models() — блокирующий сетевой вызов, уводим его с event loop
+                models = await asyncio.to_thread(lambda: list(genai.list_models()))
+            except Exception as e:
+                logger.error(f"Ошибка при получении списка моделей: {e}")
+                return []
+            self._available_models = [
+                m.name for m in models if 'generateContent' in m.supported_generation_methods
+            ]
+            logger.info(f"Доступные модели: {self._available_models}")
+            return self._available_models
+
+    async def analyze_all(self, messages: List[Dict[str, Any]]) -> Dict[str, str]:
+        """
+        Общий анализ, анализ конфликта и дайджест советов одновременно.
+        Сообщения форматируются один раз, запросы к Gemini выполняются параллельно.
+        """
+        if not messages:
+            empty = "❌ Нет сообщений для анализа."
+            return {"analysis": empty, "conflict": empty, "tips": empty}
+
+        window, omitted = self._select_window(messages)
+        if len(window) < Config.MIN_MESSAGES_FOR_ANALYSIS:
+            return dict.fromkeys(("analysis", "conflict", "tips"), _NOT_ENOUGH_MESSAGES)
+        formatted_messages = await self._format_messages_offloaded(window, omitted)
+        results = await asyncio.gather(
+            *(self._analyze_window(kind, window, omitted, formatted_messages)
+              for kind in (AnalysisKind.GROUP, AnalysisKind.CONFLICT, AnalysisKind.TIPS)),
+            return_exceptions=True,
+        )
+        reports = {}
+        for kind, result in zip(("analysis", "conflict", "tips"), results):
+            if isinstance(result, BaseException):
+                logger.error(f"Analysis '{kind}' failed: {result}")
+                result = f"❌ Ошибка при анализе: {escape_markdown(str(result))}"
+            reports[kind] = result
+        return reports
 
     async def analyze_messages(self, messages: List[Dict[str, Any]]) -> str:
         """Анализ групповых сообщений, возвращает отчёт."""
@@ -113,17 +659,39 @@ class CommunicationAnalyzer:
             return "❌ Нет сообщений для анализа."
 
         try:
-            formatted_messages = self._format_messages(messages)
+            window, omitted = self._select_window(messages)
+            if len(window) < Config.MIN_MESSAGES_FOR_ANALYSIS:
+                return _NOT_ENOUGH_MESSAGES
+            return await self._analyze_window(AnalysisKind.GROUP, window, omitted)
+        except Exception as e:
+            logger.error(f"Analysis failed: {e}")
+            return f"❌ Ошибка при анализе: {escape_markdown(str(e))}"
+
+    async def _analyze_window(self, kind: AnalysisKind, window: List[Dict[str, Any]], omitted: int,
+                              formatted_messages: Optional[str] = None) -> str:
+        """Отчёт нужного вида по уже выбранному окну; formatted_messages — общий транскрипт analyze_all"""
+        if kind is not AnalysisKind.GROUP:
+            return await self._cached_text_report(
+                kind, window, omitted, formatted_messages, _TEXT_REPORT_PROMPTS[kind])
+
+        report_key = PromptCache.make_key(AnalysisKind.GROUP, omitted, window)
+        cached = self._report_cache.get(report_key)
+        if cached is not None:
+            logger.info("Отчёт взят из кеша: сообщения не изменились")
+            return cached
+
+        # Повторный /analyze того же окна, пока первый ещё считается, ждёт его отчёт
+        return await self._run_shared(report_key, lambda: self._build_group_report(
+            report_key, window, omitted, formatted_messages))
+
+    async def _build_group_report(self, report_key: bytes, messages: List[Dict[str, Any]],
+                                  omitted: int, formatted_messages: Optional[str]) -> str:
+        try:
+            if formatted_messages is None:
+                formatted_messages = await self._format_messages_offloaded(messages, omitted)
             analysis_prompt = self._create_analysis_prompt(formatted_messages, len(messages))
-            system_prompt = self._get_system_prompt()
-            
-            response_content = await self._call_gemini(
-                system_prompt=system_prompt,
-                user_prompt=analysis_prompt,
-                temperature=0.4,
-                max_tokens=3000,
-                response_json=True
-            )
+            response_content = await self._call_spec(
+                AnalysisKind.GROUP, analysis_prompt, len(messages), _similarity_scope(messages))
 
             if not response_content:
                 return "❌ Получен пустой ответ от AI."
@@ -132,15 +700,17 @@ class CommunicationAnalyzer:
             if response_content.startswith("❌") or response_content.startswith("⚠️"):
                 return response_content
 
-            analysis_json = json.loads(response_content)
-            return self._format_analysis_report(analysis_json, len(messages))
+            analysis_json = _json_loads(response_content)
+            report = self._format_analysis_report(analysis_json, len(messages), omitted)
+            self._report_cache.put(report_key, report)
+            return report
 
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse AI response as JSON: {e}")
             return "❌ Ошибка обработки ответа AI. Попробуйте позже."
         except Exception as e:
             logger.error(f"Analysis failed: {e}")
-            return f"❌ Ошибка при анализе: {str(e)}"
+            return f"❌ Ошибка при анализе: {escape_markdown(str(e))}"
 
     async def analyze_user_communication(
         self,
@@ -153,17 +723,35 @@ class CommunicationAnalyzer:
             return "❌ Нет сообщений пользователя для анализа."
 
         try:
-            analysis_prompt = self._create_personal_analysis_prompt(
-                user_messages, interactions, username)
-            system_prompt = self._get_personal_analysis_system_prompt()
-            
-            response_content = await self._call_gemini(
-                system_prompt=system_prompt,
-                user_prompt=analysis_prompt,
-                temperature=0.4,
-                max_tokens=3500,
-                response_json=True
-            )
+            report_key = PromptCache.make_key(
+                AnalysisKind.PERSONAL, username, user_messages, interactions)
+            cached = self._report_cache.get(report_key)
+            if cached is not None:
+                logger.info("Персональный отчёт взят из кеша: сообщения не изменились")
+                return cached
+
+            return await self._run_shared(report_key, lambda: self._build_personal_report(
+                report_key, user_messages, interactions, username))
+        except Exception as e:
+            logger.error(f"Personal analysis failed: {e}")
+            return f"❌ Ошибка при анализе: {escape_markdown(str(e))}"
+
+    async def _build_personal_report(self, report_key: bytes,
+                                     user_messages: List[Dict[str, Any]],
+                                     interactions: Dict[str, List[Dict[str, Any]]],
+                                     username: str) -> str:
+        try:
+            prompt_lines = (min(len(user_messages), _PERSONAL_PROMPT_MESSAGES)
+                            + _PERSONAL_PROMPT_INTERACTIONS * len(interactions))
+            if prompt_lines > _OFFLOAD_MIN_LINES:
+                analysis_prompt = await asyncio.to_thread(
+                    self._create_personal_analysis_prompt, user_messages, interactions, username)
+            else:
+                analysis_prompt = self._create_personal_analysis_prompt(
+                    user_messages, interactions, username)
+            response_content = await self._call_spec(
+                AnalysisKind.PERSONAL, analysis_prompt, len(user_messages),
+                _similarity_scope(user_messages, per_user=True))
 
             if not response_content:
                 return "❌ Получен пустой ответ от AI."
@@ -171,15 +759,17 @@ class CommunicationAnalyzer:
             if response_content.startswith("❌") or response_content.startswith("⚠️"):
                 return response_content
 
-            analysis_json = json.loads(response_content)
-            return self._format_personal_analysis_report(analysis_json, username, len(user_messages))
+            analysis_json = _json_loads(response_content)
+            report = self._format_personal_analysis_report(analysis_json, username, len(user_messages))
+            self._report_cache.put(report_key, report)
+            return report
 
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse personal analysis as JSON: {e}")
             return "❌ Ошибка обработки ответа AI."
         except Exception as e:
             logger.error(f"Personal analysis failed: {e}")
-            return f"❌ Ошибка при анализе: {str(e)}"
+            return f"❌ Ошибка при анализе: {escape_markdown(str(e))}"
 
     async def analyze_conflict(self, messages: List[Dict[str, Any]]) -> str:
         """Анализ конфликта в диалоге."""
@@ -187,26 +777,13 @@ class CommunicationAnalyzer:
             return "❌ Нет сообщений для анализа."
 
         try:
-            formatted_messages = self._format_messages(messages)
-            system_prompt = """Ты - профессиональный медиатор. Проанализируй диалог и опиши структуру конфликта: 
-- Стороны (никнеймы)
-- Причина (из-за чего искра)
-- Эскалация (как накалялось)
-- Аргументы сторон (кто что говорил)
-- Итог (помирились или нет)"""
-            user_prompt = f"Вот диалог:\n{formatted_messages}\n\nОпиши структуру конфликта."
-
-            response = await self._call_gemini(
-                system_prompt=system_prompt,
-                user_prompt=user_prompt,
-                temperature=0.3,
-                max_tokens=2000,
-                response_json=False
-            )
-            return response
+            window, omitted = self._select_window(messages)
+            if len(window) < Config.MIN_MESSAGES_FOR_ANALYSIS:
+                return _NOT_ENOUGH_MESSAGES
+            return await self._analyze_window(AnalysisKind.CONFLICT, window, omitted)
         except Exception as e:
             logger.error(f"Conflict analysis failed: {e}")
-            return f"❌ Ошибка при анализе конфликта: {str(e)}"
+            return f"❌ Ошибка при анализе конфликта: {escape_markdown(str(e))}"
 
     async def analyze_tips(self, messages: List[Dict[str, Any]]) -> str:
         """Выделение полезных советов из диалога."""
@@ -214,45 +791,126 @@ class CommunicationAnalyzer:
             return "❌ Нет сообщений для анализа."
 
         try:
-            formatted_messages = self._format_messages(messages)
-            system_prompt = """Ты - редактор дайджеста. Выдели из переписки 3-5 самых ценных мыслей, советов или лайфхаков. 
-Если это диалог (вопрос-ответ), опиши проблему и предложенное решение. Используй понятный язык."""
-            user_prompt = f"Вот переписка:\n{formatted_messages}\n\nВыдели полезные советы и идеи."
-
-            response = await self._call_gemini(
-                system_prompt=system_prompt,
-                user_prompt=user_prompt,
-                temperature=0.3,
-                max_tokens=2000,
-                response_json=False
-            )
-            return response
+            window, omitted = self._select_window(messages)
+            if len(window) < Config.MIN_MESSAGES_FOR_ANALYSIS:
+                return _NOT_ENOUGH_MESSAGES
+            return await self._analyze_window(AnalysisKind.TIPS, window, omitted)
         except Exception as e:
             logger.error(f"Tips analysis failed: {e}")
-            return f"❌ Ошибка при выделении советов: {str(e)}"
+            return f"❌ Ошибка при выделении советов: {escape_markdown(str(e))}"
+
+    async def _cached_text_report(self, kind: AnalysisKind, messages: List[Dict[str, Any]],
+                                  omitted: int, formatted_messages: Optional[str],
+                                  prompt_template: str) -> str:
+        """Текстовый отчёт по окну сообщений с тем же кешем отчётов, что и у analyze_messages"""
+        report_key = PromptCache.make_key(kind, omitted, messages)
+        cached = self._report_cache.get(report_key)
+        if cached is not None:
+            logger.info(f"Отчёт '{kind.value}' взят из кеша: сообщения не изменились")
+            return cached
+
+        async def build() -> str:
+            text = formatted_messages
+            if text is None:
+                text = await self._format_messages_offloaded(messages, omitted)
+            report = await self._call_spec(
+                kind, prompt_template.format(text), len(messages), _similarity_scope(messages))
+            if report and not report.startswith(("❌", "⚠️")):
+                # Разметку модели не экранируем — она и должна отрисоваться; экранируются только
+                # подставленные поля и тексты ошибок, а битый Markdown _deliver отправит простым текстом
+                self._report_cache.put(report_key, report)
+            return report
 
-    def _get_system_prompt(self) -> str:
-        return Config.GROUP_ANALYSIS_SYSTEM_PROMPT
+        return await self._run_shared(report_key, build)
 
-    def _get_personal_analysis_system_prompt(self) -> str:
-        return Config.PERSONAL_ANALYSIS_SYSTEM_PROMPT
+    def _trim_to_token_budget(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Оставляет самые свежие сообщения, которые помещаются в бюджет входных токенов.
+        Токены оцениваются по длине текста без сетевого вызова count_tokens().
+        """
+        budget_chars = Config.MAX_INPUT_TOKENS * _CHARS_PER_TOKEN
+        text_limit = Config.MAX_CHARS_PER_MESSAGE
+        # Накопленная длина строк транскрипта с конца (время + имя + текст)
+        suffix_lengths = list(accumulate(
+            _LINE_OVERHEAD
+            + len(msg.get("username") or "")
+            + min(len(msg.get("text") or ""), text_limit)
+            for msg in reversed(messages)
+        ))
+        keep = bisect_right(suffix_lengths, budget_chars)
+        if keep >= len(messages):
+            return messages
+        logger.info(f"Prompt trimmed to the last {keep} of {len(messages)} messages to fit token budget")
+        return messages[len(messages) - keep:]
+
+    def _select_window(self, messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Окно для анализа: только содержательные сообщения, в пределах бюджета
+        токенов и MAX_MESSAGES_FOR_ANALYSIS.
+        Из длинной истории берутся начало (контекст) и конец (свежие сообщения);
+        возвращает окно и число пропущенных между ними сообщений.
+        """
+        total = len(messages)
+        meaningful = []
+        previous = None
+        for msg in messages:
+            text = (msg.get("text") or "").strip()
+            # Пустые и односложные реплики ("ок", "+") не несут содержания для анализа
+            if len(text) <= _MIN_MEANINGFUL_CHARS:
+                continue
+            # Повтор того же текста тем же автором подряд (флуд, повторная отправка) — один раз
+            key = (msg.get("user_id", msg.get("username")), text)
+            if key == previous:
+                continue
+            previous = key
+            meaningful.append(msg)
+        if len(meaningful) < total:
+            logger.debug(f"Filtered analysis input: {total} -> {len(meaningful)} messages")
+        messages = self._trim_to_token_budget(meaningful)
+        limit = Config.MAX_MESSAGES_FOR_ANALYSIS
+        if len(messages) <= limit:
+            return messages, 0
+        head = min(_WINDOW_HEAD_MESSAGES, limit // 2)
+        omitted = len(messages) - limit
+        logger.info(f"Analysis window capped to {limit} of {len(messages)} messages")
+        return messages[:head] + messages[head + omitted:], omitted
+
+    async def _format_messages_offloaded(self, messages: List[Dict[str, Any]],
+                                         omitted: int = 0) -> str:
+        """_format_messages; большие окна форматируются в потоке, не блокируя event loop"""
+        if omitted:
+            # Окно из _select_window: отмечаем разрыв между началом и концом истории
+            head = min(_WINDOW_HEAD_MESSAGES, Config.MAX_MESSAGES_FOR_ANALYSIS // 2)
+            return "\n".join((
+                await self._format_messages_offloaded(messages[:head]),
+                f"... [пропущено сообщений: {omitted}] ...",
+                await self._format_messages_offloaded(messages[head:]),
+            ))
+        if len(messages) > _OFFLOAD_MIN_LINES:
+            return await asyncio.to_thread(self._format_messages, messages)
+        return self._format_messages(messages)
 
     def _format_messages(self, messages: List[Dict[str, Any]]) -> str:
         """Форматирует список сообщений в строку для AI."""
+        # Метка времени с точностью до минуты общая для соседних сообщений:
+        # strftime вызывается один раз на минуту, а не на каждое сообщение
+        stamps: Dict[Any, str] = {}
+        text_limit = Config.MAX_CHARS_PER_MESSAGE
         lines = []
         for msg in messages:
             ts = msg.get("timestamp")
-            if hasattr(ts, "strftime"):
-                timestamp = ts.strftime("%Y-%m-%d %H:%M")
-            else:
-                timestamp = str(ts)
-            username = msg.get("username", "Пользователь")
-            text = msg.get("text", "")
-            lines.append(f"[{timestamp}] {username}: {text}")
+            minute = ts.replace(second=0, microsecond=0) if hasattr(ts, "strftime") else ts
+            stamp = stamps.get(minute)
+            if stamp is None:
+                stamp = stamps[minute] = _fmt_ts(ts)
+            text = msg.get('text', '')
+            if text and len(text) > text_limit:
+                text = text[:text_limit] + "…"
+            lines.append(f"[{stamp}] {msg.get('username', 'Пользователь')}: {text}")
         return "\n".join(lines)
 
     def _create_analysis_prompt(self, formatted_messages: str, message_count: int) -> str:
-        return Config.GROUP_ANALYSIS_USER_PROMPT_TEMPLATE.format(
+        return _GROUP_USER_PROMPT.render(
             message_count=message_count,
             formatted_messages=formatted_messages
         )
@@ -263,118 +921,83 @@ class CommunicationAnalyzer:
         interactions: Dict[str, List[Dict[str, Any]]],
         username: str,
     ) -> str:
-        user_msgs_formatted = []
-        for msg in user_messages[-20:]:
-            ts = msg.get("timestamp")
-            if hasattr(ts, "strftime"):
-                timestamp = ts.strftime("%Y-%m-%d %H:%M")
-            else:
-                timestamp = str(ts)
-            text = msg.get("text", "")
-            user_msgs_formatted.append(f"[{timestamp}] {text}")
+        user_msgs_formatted = [
+            f"[{_fmt_ts(msg.get('timestamp'))}] {msg.get('text', '')}"
+            for msg in _tail(user_messages, _PERSONAL_PROMPT_MESSAGES)
+        ]
 
         interactions_formatted = []
         for partner, msgs in interactions.items():
-            if partner == "self":
+            if partner == "self" or not msgs:
                 continue
-            if msgs:
-                interactions_formatted.append(f"\n--- Взаимодействие с {partner} ---")
-                for interaction in msgs[-5:]:
-                    if interaction.get("type") == "interaction":
-                        partner_msg = interaction.get("partner_message", {})
-                        user_msg = interaction.get("user_message")
-                        p_ts = partner_msg.get("timestamp")
-                        if hasattr(p_ts, "strftime"):
-                            p_time = p_ts.strftime("%Y-%m-%d %H:%M")
-                        else:
-                            p_time = str(p_ts)
-                        interactions_formatted.append(
-                            f"[{p_time}] {partner}: {partner_msg.get('text', '')}"
-                        )
-                        if user_msg:
-                            u_ts = user_msg.get("timestamp")
-                            if hasattr(u_ts, "strftime"):
-                                u_time = u_ts.strftime("%Y-%m-%d %H:%M")
-                            else:
-                                u_time = str(u_ts)
-                            interactions_formatted.append(
-                                f"[{u_time}] {username}: {user_msg.get('text', '')}"
-                            )
-
-        prompt = Config.PERSONAL_ANALYSIS_USER_PROMPT_TEMPLATE.format(
+            interactions_formatted.append(f"\n--- Взаимодействие с {partner} ---")
+            for interaction in _tail(msgs, _PERSONAL_PROMPT_INTERACTIONS):
+                if interaction.get("type") != "interaction":
+                    continue
+                partner_msg = interaction.get("partner_message", {})
+                interactions_formatted.append(
+                    f"[{_fmt_ts(partner_msg.get('timestamp'))}] {partner}: {partner_msg.get('text', '')}"
+                )
+                user_msg = interaction.get("user_message")
+                if user_msg:
+                    interactions_formatted.append(
+                        f"[{_fmt_ts(user_msg.get('timestamp'))}] {username}: {user_msg.get('text', '')}"
+                    )
+
+        return _PERSONAL_USER_PROMPT.render(
             username=username,
             user_messages="\n".join(user_msgs_formatted),
             interactions="\n".join(interactions_formatted)
         )
-        return prompt
 
-    def _format_analysis_report(self, analysis: Dict[str, Any], message_count: int) -> str:
+    def _format_analysis_report(self, analysis: Dict[str, Any], message_count: int,
+                                omitted: int = 0) -> str:
         """Форматирует JSON-ответ AI в читаемый отчёт."""
-        report = (
-            f"📊 *Анализ коммуникаций*\n\n"
-            f"📝 Проанализировано сообщений: {message_count}\n\n"
-            f"🎯 *Тон общения:* {analysis.get('communication_tone', 'Не определён')}\n\n"
-            f"📈 *Эффективность:* {analysis.get('effectiveness_score', 'N/A')}/10\n\n"
-            f"🌍 *Атмосфера в команде:* {analysis.get('team_atmosphere', 'Не определена')}\n"
+        sections = {
+            name: _bullet_section(heading, analysis.get(key, []))
+            for name, key, heading in _GROUP_REPORT_SECTIONS
+        }
+        return _GROUP_REPORT_TEMPLATE.format(
+            message_count=message_count,
+            omitted_note=f"✂️ Из середины истории пропущено сообщений: {omitted}\n\n" if omitted else "",
+            tone=escape_markdown(analysis.get('communication_tone', 'Не определён')),
+            score=escape_markdown(analysis.get('effectiveness_score', 'N/A')),
+            atmosphere=escape_markdown(analysis.get('team_atmosphere', 'Не определена')),
+            when=_report_stamp(),
+            **sections,
         )
 
-        positive = analysis.get("positive_patterns", [])
-        if positive:
-            report += "\n✅ *Позитивные паттерны:*"
-            for p in positive:
-                report += f"\n• {p}"
-
-        improvements = analysis.get("improvement_areas", [])
-        if improvements:
-            report += "\n\n⚠️ *Области для улучшения:*"
-            for i in improvements:
-                report += f"\n• {i}"
-
-        recs = analysis.get("recommendations", [])
-        if recs:
-            report += "\n\n💡 *Рекомендации:*"
-            for r in recs:
-                report += f"\n• {r}"
-
-        report += f"\n\n---\n📅 Анализ выполнен: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        return report
-
     def _format_personal_analysis_report(self, analysis: Dict[str, Any],
                                           username: str,
                                           message_count: int) -> str:
-        report = (
-            f"👤 *Персональный анализ для @{username}*\n\n"
+        parts: List[str] = [
+            f"👤 *Персональный анализ для @{escape_markdown(username)}*\n\n"
             f"📊 Проанализировано {message_count} сообщений\n\n"
             f"🧭 *Общий вывод:*\n"
-            f"{analysis.get('overall_summary', 'Не определен')}\n\n"
-            f"📈 *Эффективность коммуникации:* {analysis.get('communication_effectiveness', 'N/A')}/10\n"
-        )
+            f"{escape_markdown(analysis.get('overall_summary', 'Не определен'))}\n\n"
+            f"📈 *Эффективность коммуникации:* {escape_markdown(analysis.get('communication_effectiveness', 'N/A'))}/10\n"
+        ]
 
-        strengths = analysis.get("strengths", [])
-        if strengths:
-            report += "\n✅ *Сильные стороны:*"
-            for s in strengths:
-                report += f"\n• {s}"
+        parts.append(_bullet_section("\n✅ *Сильные стороны:*", analysis.get("strengths", [])))
 
         motivating = analysis.get("motivating_feedback", [])
         if motivating:
-            report += "\n\n🌟 *Мотивирующая обратная связь:*"
+            parts.append("\n\n🌟 *Мотивирующая обратная связь:*")
             for item in motivating:
                 quote = item.get("quote")
                 ctx = item.get("context")
                 result = item.get("positive_result")
-                line = "• "
+                parts.append("\n• ")
                 if quote:
-                    line += f"«{quote}»"
+                    parts.append(f"«{escape_markdown(quote)}»")
                 if ctx:
-                    line += f" — контекст: {ctx}"
+                    parts.append(f" — контекст: {escape_markdown(ctx)}")
                 if result:
-                    line += f" — результат: {result}"
-                report += f"\n{line}"
+                    parts.append(f" — результат: {escape_markdown(result)}")
 
         development = analysis.get("development_feedback", [])
         if development:
-            report += "\n\n🛠️ *Зоны для развития:*"
+            parts.append("\n\n🛠️ *Зоны для развития:*")
             for item in development:
                 quote = item.get("quote")
                 action = item.get("action")
@@ -383,37 +1006,27 @@ class CommunicationAnalyzer:
                 suggestion = item.get("improvement_suggestion")
 
                 if quote or action:
-                    report += "\n• Ситуация:"
+                    parts.append("\n• Ситуация:")
                     if quote:
-                        report += f" «{quote}»"
+                        parts.append(f" «{escape_markdown(quote)}»")
                     if action:
-                        report += f" | Действие: {action}"
+                        parts.append(f" | Действие: {escape_markdown(action)}")
                 if cons:
-                    report += f"\n  Последствия: {cons}"
+                    parts.append(f"\n  Последствия: {escape_markdown(cons)}")
                 if question:
-                    report += f"\n  Вопрос: {question}"
+                    parts.append(f"\n  Вопрос: {escape_markdown(question)}")
                 if suggestion:
-                    report += f"\n  Альтернатива: {suggestion}"
+                    parts.append(f"\n  Альтернатива: {escape_markdown(suggestion)}")
 
         interaction_patterns = analysis.get("interaction_patterns", {})
         if interaction_patterns:
-            report += "\n\n🤝 *Особенности взаимодействия:*"
-            for partner, pattern in interaction_patterns.items():
-                report += f"\n• С {partner}: {pattern}"
-
-        recs = analysis.get("recommendations", [])
-        if recs:
-            report += "\n\n💡 *Практические рекомендации:*"
-            for rec in recs:
-                report += f"\n• {rec}"
-
-        agreements = analysis.get("agreements", [])
-        if agreements:
-            report += "\n\n📝 *Договоренности/следующие шаги:*"
-            for agr in agreements:
-                report += f"\n• {agr}"
-
-        report += f"\n\n---\n📅 Анализ выполнен: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        report += "\n🔒 Этот отчет конфиденциален и отправлен только вам."
-
-        return report
+            parts.append("\n\n🤝 *Особенности взаимодействия:*")
+            parts.extend(f"\n• С {escape_markdown(partner)}: {escape_markdown(pattern)}" for partner, pattern in interaction_patterns.items())
+
+        parts.append(_bullet_section("\n\n💡 *Практические рекомендации:*", analysis.get("recommendations", [])))
+        parts.append(_bullet_section("\n\n📝 *Договоренности/следующие шаги:*", analysis.get("agreements", [])))
+
+        parts.append(f"\n\n---\n📅 Анализ выполнен: {_report_stamp()}")
+        parts.append("\n🔒 Этот отчет конфиденциален и отправлен только вам.")
+
+        return "".join(parts)
@@ -11,14 +11,40 @@ import asyncio
 import logging
 import sys
 import os
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 # Добавляем корень проекта в путь Python, чтобы найти main.py, config.py и т.д.
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from http.server import BaseHTTPRequestHandler
 
+# orjson разбирает bytes напрямую, без отдельного decode; JSONDecodeError
+# у него — подкласс json.JSONDecodeError, так что обработка ошибок общая
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_loads(body: bytes):
+        return json.loads(body.decode('utf-8'))
+
+# uvloop быстрее стандартного loop; на Windows его нет — используем asyncio
+try:
+    import uvloop
+    _new_event_loop = uvloop.new_event_loop
+except ImportError:
+    _new_event_loop = asyncio.new_event_loop
+
 logger = logging.getLogger(__name__)
 
+# ✅ Один event loop на весь процесс вместо asyncio.run() на каждый запрос:
+# не создаём loop заново, а сессия бота и клиенты живут между апдейтами
+_LOOP = _new_event_loop()
+threading.Thread(target=_LOOP.run_forever, name="webhook-loop", daemon=True).start()
+
+# Сколько ждём обработки апдейта, прежде чем ответить Telegram
+_UPDATE_TIMEOUT = 25
+
 
 class handler(BaseHTTPRequestHandler):
     """
@@ -26,6 +52,10 @@ class handler(BaseHTTPRequestHandler):
     Telegram присылает POST-запросы с данными о новых сообщениях.
     """
 
+    # ✅ HTTP/1.1: соединение с Telegram остаётся открытым между апдейтами
+    # (для этого каждый ответ обязан содержать Content-Length)
+    protocol_version = "HTTP/1.1"
+
     def do_POST(self):
         """Обрабатываем POST-запрос от Telegram"""
         try:
@@ -36,11 +66,17 @@ class handler(BaseHTTPRequestHandler):
                 return
 
             body = self.rfile.read(content_length)
-            update_data = json.loads(body.decode('utf-8'))
+            update_data = _json_loads(body)
 
             # ✅ Импортируем handle_update из main.py и запускаем
             from main import handle_update
-            asyncio.run(handle_update(update_data))
+            future = asyncio.run_coroutine_threadsafe(handle_update(update_data), _LOOP)
+            try:
+                future.result(timeout=_UPDATE_TIMEOUT)
+            except FutureTimeoutError:
+                # Апдейт продолжает обрабатываться в loop; отвечаем 200,
+                # чтобы Telegram не прислал его повторно
+                logger.warning(f"Update processing exceeded {_UPDATE_TIMEOUT}s, continuing in background")
 
             # Отвечаем Telegram "всё хорошо"
             self._send_response(200, "OK")
@@ -61,11 +97,15 @@ class handler(BaseHTTPRequestHandler):
 
     def _send_response(self, status_code: int, message: str):
         """Вспомогательная функция для отправки ответа"""
+        body = message.encode('utf-8')
         self.send_response(status_code)
         self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(message.encode('utf-8'))
+        self.wfile.write(body)
 
     def log_message(self, format, *args):
-        """Перенаправляем логи Vercel в стандартный logger"""
-        logger.info(f"Webhook: {format % args}")
+        """Перенаправляем access-логи в стандартный logger (только при LOG_LEVEL=DEBUG)"""
+        # ✅ Строка форматируется logging'ом, только если DEBUG включён
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Webhook: " + format, *args)
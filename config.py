@@ -27,14 +27,51 @@ class Config:
     # Optional configurations with defaults
     CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1000"))  # Max messages per chat in database
     MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "50"))  # Max messages per chat in memory
-    RATE_LIMIT_SECONDS = int(os.getenv("RATE_LIMIT_SECONDS", "10"))  # Seconds between commands
+    MEMORY_MAX_CHATS = int(os.getenv("MEMORY_MAX_CHATS", "1000"))  # Chats kept in memory; least active are evicted
+    DUPLICATE_WINDOW_SECONDS = int(os.getenv("DUPLICATE_WINDOW_SECONDS", "60"))  # Drop repeated text from the same user (0 disables)
+    RATE_LIMIT_SECONDS = int(os.getenv("RATE_LIMIT_SECONDS", "10"))  # Seconds to earn one command back
+    RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "1"))  # Commands a user can fire back-to-back
+    RATE_LIMIT_ANALYSIS_COST = int(os.getenv("RATE_LIMIT_ANALYSIS_COST", "1"))  # Tokens per full chat analysis
+    # Sliding window on top of the per-command interval: at most N commands per window (0 minutes disables)
+    RATE_LIMIT_WINDOW_MINUTES = int(os.getenv("RATE_LIMIT_WINDOW_MINUTES", "0"))
+    RATE_LIMIT_MAX_COMMANDS = int(os.getenv("RATE_LIMIT_MAX_COMMANDS", "15"))
+    PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "128"))  # Max cached Gemini responses
+    # Near-duplicate response cache: reuse an answer when the prompt lines overlap enough (0 disables).
+    # Matches are looked up only among prompts built from the same chat (and user for personal analysis)
+    SIMILAR_CACHE_THRESHOLD = float(os.getenv("SIMILAR_CACHE_THRESHOLD", "0"))
+    SIMILAR_CACHE_SIZE = int(os.getenv("SIMILAR_CACHE_SIZE", "32"))
+    SIMILAR_CACHE_TTL = int(os.getenv("SIMILAR_CACHE_TTL", "3600"))  # Seconds
+    MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "120000"))  # Prompt budget for the message transcript
+    MIN_MESSAGES_FOR_ANALYSIS = int(os.getenv("MIN_MESSAGES_FOR_ANALYSIS", "5"))  # Substantive messages needed to call Gemini
+    MAX_MESSAGES_FOR_ANALYSIS = int(os.getenv("MAX_MESSAGES_FOR_ANALYSIS", "400"))  # Head + tail kept from long histories
+    MAX_CHARS_PER_MESSAGE = int(os.getenv("MAX_CHARS_PER_MESSAGE", "500"))  # Longer message texts are cut in the prompt
+
+    # Gemini explicit context caching for large static system prompts (billed separately, off by default)
+    GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() in {"1", "true", "yes", "on"}
+    GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))  # Seconds
+    MAX_CONCURRENT_ANALYSES = int(os.getenv("MAX_CONCURRENT_ANALYSES", "4"))  # Parallel AI requests across all chats
+    # Outgoing message pacing under Telegram limits (~30 msg/s per bot, ~1 msg/s per chat); 0 disables
+    SEND_MAX_PER_SECOND = int(os.getenv("SEND_MAX_PER_SECOND", "25"))
+    GROUP_SEND_INTERVAL_SECONDS = float(os.getenv("GROUP_SEND_INTERVAL_SECONDS", "1"))
     # ✅ УДАЛЕНА строка: DB_PATH = os.getenv("DB_PATH", "messages.db") — она перезаписывала /tmp путь!
 
     # Disable Telegram markdown formatting and send plain text only
     PLAIN_TEXT_OUTPUT = os.getenv("PLAIN_TEXT_OUTPUT", "false").lower() in {"1", "true", "yes", "on"}
+
+    # Self-hosted webhook server instead of long polling (Vercel uses api/webhook.py)
+    USE_WEBHOOK = os.getenv("USE_WEBHOOK", "false").lower() in {"1", "true", "yes", "on"}
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public base URL, e.g. https://bot.example.com
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None  # Checked against X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
     
     # Authorized users (comma-separated list of Telegram user IDs)
-    AUTHORIZED_USERS = [int(x.strip()) for x in os.getenv("AUTHORIZED_USERS", "").split(",") if x.strip()]
+    _authorized_ids = [int(x.strip()) for x in os.getenv("AUTHORIZED_USERS", "").split(",") if x.strip()]
+    AUTHORIZED_USERS = set(_authorized_ids)
+    # The first user in the list is the main admin
+    MAIN_ADMIN_ID = _authorized_ids[0] if _authorized_ids else None
+    del _authorized_ids
     
     # Logging level
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -113,12 +150,25 @@ class Config:
 }
 Будь уважительным, точным, поддерживающим и сфокусированным на росте."""
 
-    GROUP_ANALYSIS_USER_PROMPT_TEMPLATE = """Проанализируй следующие {message_count} сообщений из рабочего чата и предоставь структурированный анализ 
+    CONFLICT_ANALYSIS_SYSTEM_PROMPT = """Ты - профессиональный медиатор. Проанализируй диалог и опиши структуру конфликта: 
+- Стороны (никнеймы)
+- Причина (из-за чего искра)
+- Эскалация (как накалялось)
+- Аргументы сторон (кто что говорил)
+- Итог (помирились или нет)"""
+
+    TIPS_ANALYSIS_SYSTEM_PROMPT = """Ты - редактор дайджеста. Выдели из переписки 3-5 самых ценных мыслей, советов или лайфхаков. 
+Если это диалог (вопрос-ответ), опиши проблему и предложенное решение. Используй понятный язык."""
+
+    # Неизменная инструкция идёт до любых подстановок: одинаковый префикс запроса
+    # позволяет Gemini применять неявное кеширование. Переменные поля — только в конце.
+    GROUP_ANALYSIS_USER_PROMPT_TEMPLATE = """Проанализируй сообщения из рабочего чата и предоставь структурированный анализ 
 коммуникации по принципам качественной ОС (своевременность, непубличность, ясность, факты, конструктивность).
+Выдели паттерны коммуникации и дай объективную оценку с практическими рекомендациями.
 
-{formatted_messages}
+Количество сообщений: {message_count}
 
-Выдели паттерны коммуникации и дай объективную оценку с практическими рекомендациями."""
+{formatted_messages}"""
 
     PERSONAL_ANALYSIS_USER_PROMPT_TEMPLATE = """Проанализируй стиль коммуникации пользователя {username}.
 
@@ -197,6 +247,26 @@ class Config:
         "no_messages_for_analysis": "❌ Нет ваших сообщений для анализа в этом чате.",
         "analysis_sent_private": "✅ Анализ коммуникации @{username} отправлен в личные сообщения.",
         "analysis_error": "❌ Ошибка при анализе: {error}",
+        "analysis_error_short": "❌ Ошибка: {error}",
+        "analysis_target_unknown": "❌ Не удалось определить пользователя для анализа.",
+        "user_not_in_cache": "❌ Пользователь @{username} не найден в кеше сообщений.",
+        "user_not_found_anywhere": "❌ Пользователь @{username} не найден.",
+        "username_required": "❌ Неверный формат. Используйте @username.",
+        "invalid_format_short": "❌ Неверный формат.",
+        "analyzing_user_style": "🤔 Анализирую стиль коммуникации {username}...",
+        "no_user_messages": "❌ Нет сообщений от {username}.",
+        "user_analysis_sent_private": "✅ Анализ {username} отправлен в личные сообщения.",
+        "analyze_user_all_usage": "❌ Использование: /analyze_user_all @username или <user_id>",
+        "analyzing_user_style_all_chats": "🤔 Анализирую стиль коммуникации из всех чатов...",
+        "no_user_messages_all_chats": "❌ Нет сообщений от {username} ни в одном чате.",
+        "user_analysis_all_sent_private": "✅ Анализ {username} из всех чатов отправлен в личные сообщения.",
+        "rate_limit_short": "⏱️ Подождите {rate_limit} секунд.",
+        "not_enough_messages": "❌ Недостаточно сообщений.",
+        "no_messages_24h": "❌ За последние 24 часа не было сообщений.",
+        "analyzing_conflict": "🔍 Анализирую конфликт... ⏳",
+        "conflict_template": "📝 *Анализ конфликта:*\n\n{report}",
+        "collecting_tips": "🔍 Собираю советы за 24 часа... ⏳",
+        "digest_template": "💡 *Дайджест советов:*\n\n{report}",
 
         "chat_stats_template": """📊 *Статистика чата: {chat_title}*
 
@@ -250,6 +320,18 @@ class Config:
         "period_info_template": "• Период активности: {oldest_date} - {newest_date}\n",
 
         "unknown_analysis_type": "❌ Неизвестный тип анализа.",
+        "wait_rate_limit": "⏱ Подождите {rate_limit} секунд.",
+        "analysis_group_only": "Команды анализа работают только в групповых чатах.",
+        "no_messages_yet": (
+            "❌ Нет сообщений для анализа.\n\n"
+            "Бот сохраняет сообщения только после добавления в чат. "
+            "Подождите, пока участники напишут несколько сообщений."
+        ),
+        "not_enough_messages_for": "❌ Недостаточно сообщений для анализа {description}.\nВсего в кеше: {total_messages} сообщений.",
+        "analysis_started": "🔍 Анализирую {description} ({count} сообщений). Результат будет отправлен в личные сообщения.",
+        "analysis_dm_probe": "🔄 Анализирую {description} из чата «{chat_title}». Это займёт несколько секунд...",
+        "dm_closed": "❌ Не удалось отправить сообщение в личку. Сначала напишите боту /start в личных сообщениях.",
+        "analysis_failed": "❌ Ошибка при анализе. Попробуйте позже.",
         "no_messages": "Нет сообщений",
     }
 
@@ -274,8 +356,7 @@ class Config:
         "get_last_n_messages": "SELECT chat_id, user_id, username, text, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp DESC LIMIT ?",
         "get_messages_since": "SELECT chat_id, user_id, username, text, timestamp FROM messages WHERE chat_id = ? AND timestamp >= ? ORDER BY timestamp ASC",
         
-        "get_chat_stats_count": "SELECT COUNT(*) as cnt, MIN(timestamp) as oldest, MAX(timestamp) as newest FROM messages WHERE chat_id = ?",
-        "get_chat_stats_users": "SELECT COUNT(DISTINCT user_id) as users FROM messages WHERE chat_id = ?",
+        "get_chat_stats": "SELECT COUNT(*) as cnt, COUNT(DISTINCT user_id) as users, MIN(timestamp) as oldest, MAX(timestamp) as newest FROM messages WHERE chat_id = ?",
         
         "clear_chat": "DELETE FROM messages WHERE chat_id = ?",
         "get_all_chats": "SELECT DISTINCT chat_id FROM messages",
@@ -288,6 +369,9 @@ class Config:
         
         "get_user_chat_stats_count": "SELECT COUNT(*) as cnt, MIN(timestamp) as oldest, MAX(timestamp) as newest FROM messages WHERE user_id = ?",
         "get_user_chat_stats_chats": "SELECT DISTINCT chat_id FROM messages WHERE user_id = ?",
+
+        # Известные пользователи для индекса username -> user_id (последнее имя побеждает)
+        "get_known_users": "SELECT chat_id, user_id, username, MAX(timestamp) AS last_seen FROM messages GROUP BY chat_id, user_id, username ORDER BY last_seen ASC",
     }
     
     @classmethod
@@ -1,18 +1,33 @@
 import asyncio
+import contextlib
+import functools
 import logging
 import os
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
 
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, ChatMemberOwner, ChatMemberAdministrator
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.types import Message, ChatMemberOwner, ChatMemberAdministrator, Update
 from aiogram.enums import ChatType
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.methods import EditMessageText, SendMessage
 from dotenv import load_dotenv
 import re
 
-from ai_analyzer import CommunicationAnalyzer
+try:
+    import uvloop
+except ImportError:  # uvloop не поддерживает Windows
+    uvloop = None
+
+from ai_analyzer import CommunicationAnalyzer, escape_markdown
 from message_cache import MessageCache
+from rate_limiter import AsyncTokenBucket, SlidingWindowLimiter, TokenBucket
 from config import Config
 
 # Load environment variables
@@ -20,11 +35,22 @@ load_dotenv()
 
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,
+    level=getattr(logging, Config.LOG_LEVEL.upper(), logging.INFO),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Тексты и лимиты читаются из окружения один раз при импорте config —
+# связываем их с модулем, чтобы не искать атрибуты Config в каждом хендлере
+MSG = Config.MESSAGES
+RATE_LIMIT_SECONDS = Config.RATE_LIMIT_SECONDS
+LAST_24H = timedelta(hours=24)
+# Тексты, зависящие только от настроек, форматируются один раз при импорте
+HELP_TEXT = MSG["help_text_template"].format(rate_limit=RATE_LIMIT_SECONDS)
+RATE_LIMIT_MSG = MSG["rate_limit"].format(rate_limit=RATE_LIMIT_SECONDS)
+RATE_LIMIT_SHORT_MSG = MSG["rate_limit_short"].format(rate_limit=RATE_LIMIT_SECONDS)
+WAIT_MSG = MSG["wait_rate_limit"].format(rate_limit=RATE_LIMIT_SECONDS)
+
 # ✅ ИСПРАВЛЕНО: инициализация бота перенесена в функцию get_bot()
 # Раньше bot и dp создавались на уровне модуля — это вызывало ошибку 500,
 # если TELEGRAM_BOT_TOKEN не был задан при импорте модуля на Vercel.
@@ -37,6 +63,8 @@ def get_bot() -> Bot:
     global _bot
     if _bot is None:
         _bot = Bot(token=Config.TELEGRAM_BOT_TOKEN)
+        if Config.SEND_MAX_PER_SECOND > 0:
+            _bot.session.middleware(SendPacingMiddleware())
     return _bot
 
 def get_dp() -> Dispatcher:
@@ -58,8 +86,162 @@ def get_ai_analyzer() -> CommunicationAnalyzer:
         _ai_analyzer = CommunicationAnalyzer()
     return _ai_analyzer
 
-# Track command usage for rate limiting
-user_last_command = {}
+class SendPacingMiddleware(BaseRequestMiddleware):
+    """Paces sendMessage/editMessageText under Telegram's global and per-group limits"""
+
+    _PACED_METHODS = (SendMessage, EditMessageText)
+    _MAX_GROUPS = 10_000
+
+    def __init__(self):
+        self._global = AsyncTokenBucket(Config.SEND_MAX_PER_SECOND, 1.0 / Config.SEND_MAX_PER_SECOND)
+        # chat_id -> AsyncTokenBucket; LRU, чтобы не хранить вёдра всех групп навсегда
+        self._groups: "OrderedDict[int, AsyncTokenBucket]" = OrderedDict()
+
+    def _group_bucket(self, chat_id: int) -> AsyncTokenBucket:
+        bucket = self._groups.get(chat_id)
+        if bucket is None:
+            bucket = self._groups[chat_id] = AsyncTokenBucket(1, Config.GROUP_SEND_INTERVAL_SECONDS)
+            if len(self._groups) > self._MAX_GROUPS:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, self._PACED_METHODS):
+            chat_id = method.chat_id
+            # Сначала ждём слот группы: иначе глобальный токен простаивал бы во время ожидания
+            if isinstance(chat_id, int) and chat_id < 0 and Config.GROUP_SEND_INTERVAL_SECONDS > 0:
+                await self._group_bucket(chat_id).acquire()
+            await self._global.acquire()
+        return await make_request(bot, method)
+
+
+# ✅ Token bucket: пользователь копит до RATE_LIMIT_BURST команд, одна восстанавливается
+# за RATE_LIMIT_SECONDS. При BURST=1 это прежний интервал между командами.
+# LRU-ограничение: давно неактивные пользователи вытесняются, словарь не растёт бесконечно
+_RATE_LIMIT_MAX_USERS = 10_000
+command_bucket = TokenBucket(Config.RATE_LIMIT_BURST, RATE_LIMIT_SECONDS, max_users=_RATE_LIMIT_MAX_USERS)
+
+# ✅ Скользящее окно: не больше RATE_LIMIT_MAX_COMMANDS команд за любые
+# RATE_LIMIT_WINDOW_MINUTES минут; на пользователя хранится не больше MAX_COMMANDS отметок
+command_window = (
+    SlidingWindowLimiter(Config.RATE_LIMIT_MAX_COMMANDS, Config.RATE_LIMIT_WINDOW_MINUTES * 60,
+                         max_users=_RATE_LIMIT_MAX_USERS)
+    if Config.RATE_LIMIT_WINDOW_MINUTES > 0 else None
+)
+
+
+# ✅ Анализы в одном чате выполняются по очереди, в разных чатах — параллельно.
+# Апдейты уже обрабатываются отдельными задачами (handle_as_tasks в polling,
+# отдельный HTTP-запрос на webhook), поэтому долгий анализ в одном чате не
+# задерживает команды в других. Блокировка хранится, только пока её кто-то держит.
+_chat_analysis_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def chat_analysis_lock(chat_id: int) -> asyncio.Lock:
+    lock = _chat_analysis_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_analysis_locks[chat_id] = asyncio.Lock()
+    return lock
+
+
+# ✅ Общий предел одновременных запросов к AI по всем чатам: команды сверх него
+# ждут своей очереди, а не упираются в квоту API
+_analysis_semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_ANALYSES)
+
+
+@contextlib.asynccontextmanager
+async def analysis_slot(chat_id: int):
+    """Очередь анализа в чате + глобальный лимит параллельных запросов к AI"""
+    async with chat_analysis_lock(chat_id), _analysis_semaphore:
+        yield
+
+
+# ✅ Сообщения групп сохраняются пачками: обработчик только кладёт сообщение в очередь,
+# отдельная задача пишет накопившееся одной транзакцией SQLite. Очередь работает только
+# в долгоживущем процессе (polling / USE_WEBHOOK) — на Vercel процесс может быть заморожен
+# сразу после ответа на запрос, поэтому там сообщения пишутся сразу.
+_INGEST_BATCH_SIZE = 256
+_INGEST_QUEUE_SIZE = 10_000
+_ingest_queue: "asyncio.Queue | None" = None
+
+
+def ingest_message(chat_id: int, user_id: int, username: str, text: str, timestamp: datetime):
+    """Queue a group message for the cache writer, or store it right away when there is none"""
+    if _ingest_queue is not None:
+        try:
+            _ingest_queue.put_nowait((chat_id, user_id, username, text, timestamp))
+            return
+        except asyncio.QueueFull:
+            logger.warning("Message ingest queue is full, writing directly")
+    get_message_cache().add_message(chat_id, user_id, username, text, timestamp)
+
+
+async def _cache_writer(queue: asyncio.Queue):
+    """
+    Drains the ingest queue in batches until it gets None.
+    Futures in the queue are flush points: resolved once everything queued before them is stored.
+    """
+    cache = get_message_cache()
+    # Своё соединение: поток записи не делит транзакции с соединением цикла событий,
+    # SQLite сам сериализует запись через блокировку файла
+    conn = cache.open_writer_connection()
+    try:
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < _INGEST_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            messages = [item for item in batch if isinstance(item, tuple)]
+            try:
+                # Память кеша меняется только в цикле событий; запись в SQLite с commit
+                # уходит в поток и не задерживает обработку апдейтов
+                stored = cache.remember_messages(messages)
+                if stored:
+                    await asyncio.to_thread(cache.persist_messages, stored, conn)
+            except Exception as e:
+                logger.error(f"Failed to store {len(messages)} queued message(s): {e}")
+            for item in batch:
+                if isinstance(item, asyncio.Future) and not item.done():
+                    item.set_result(None)
+            if None in batch:
+                return
+    finally:
+        conn.close()
+
+
+async def fresh_message_cache() -> MessageCache:
+    """
+    Кеш сообщений после записи того, что было в очереди к приходу команды:
+    анализ видит только что отправленные сообщения, но не ждёт более поздних из других чатов
+    """
+    queue = _ingest_queue
+    if queue is not None:
+        flushed = asyncio.get_running_loop().create_future()
+        await queue.put(flushed)
+        await flushed
+    return get_message_cache()
+
+
+@contextlib.asynccontextmanager
+async def cache_writer():
+    """Batched cache writer for the lifetime of the bot process"""
+    global _ingest_queue
+    queue = _ingest_queue = asyncio.Queue(maxsize=_INGEST_QUEUE_SIZE)
+    task = asyncio.create_task(_cache_writer(queue))
+    try:
+        yield
+    finally:
+        _ingest_queue = None
+        if not task.done():
+            # Писатель дописывает очередь до конца и закрывает своё соединение
+            await queue.put(None)
+            await task
+        # Если писатель упал, дописываем оставшееся здесь
+        leftover = [item for item in (queue.get_nowait() for _ in range(queue.qsize()))
+                    if isinstance(item, tuple)]
+        if leftover:
+            get_message_cache().add_messages_bulk(leftover)
 
 
 def is_user_authorized(user_id: int) -> bool:
@@ -67,243 +249,315 @@ def is_user_authorized(user_id: int) -> bool:
 
 
 def is_main_admin(user_id: int) -> bool:
-    return len(Config.AUTHORIZED_USERS) > 0 and user_id == Config.AUTHORIZED_USERS[0]
+    # MAIN_ADMIN_ID вычисляется один раз в config; user_id никогда не None,
+    # поэтому отдельная проверка на None не нужна
+    return user_id == Config.MAIN_ADMIN_ID
 
 
 def add_authorized_user(user_id: int) -> bool:
     if user_id not in Config.AUTHORIZED_USERS:
-        Config.AUTHORIZED_USERS.append(user_id)
+        Config.AUTHORIZED_USERS.add(user_id)
+        # Как и раньше: первый добавленный в пустой список становится главным администратором
+        if Config.MAIN_ADMIN_ID is None:
+            Config.MAIN_ADMIN_ID = user_id
         return True
     return False
 
 
 def remove_authorized_user(user_id: int) -> bool:
     if user_id in Config.AUTHORIZED_USERS and not is_main_admin(user_id):
-        Config.AUTHORIZED_USERS.remove(user_id)
+        Config.AUTHORIZED_USERS.discard(user_id)
         return True
     return False
 
 
-def check_rate_limit(user_id: int) -> bool:
-    now = datetime.now()
-    if user_id in user_last_command:
-        time_diff = now - user_last_command[user_id]
-        if time_diff < timedelta(seconds=Config.RATE_LIMIT_SECONDS):
-            return False
-    user_last_command[user_id] = now
+def check_rate_limit(user_id: int, cost: float = 1) -> bool:
+    # Проверка и списание идут без await между ними, а все обработчики выполняются
+    # в одном event loop — поэтому две конкурентные команды не пройдут лимит обе.
+    # Если check_rate_limit когда-нибудь начнут вызывать из потоков, нужен threading.Lock.
+    now = time.monotonic()
+    if not command_bucket.try_acquire(user_id, cost, now):
+        return False
+    if command_window is not None and not command_window.try_acquire(user_id, now):
+        command_bucket.refund(user_id, cost)
+        return False
     return True
 
 
+# Регулярки и таблица для Markdown компилируются один раз при импорте
+_MDV2_ESCAPE_RE = re.compile(r'([_*\[\]()~`>#+\-=|{}.!])')
+_MDV2_UNESCAPE_RE = re.compile(r'\\([_*\[\]()~`>#+\-=|{}.!])')
+# Удаление одиночных символов покрывает и парные "**"/"__"
+_MARKDOWN_STRIP_TABLE = str.maketrans('', '', '`*_')
+
+
 def escape_markdown_v2(text: str) -> str:
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+    return _MDV2_ESCAPE_RE.sub(r'\\\1', text)
 
 
 def strip_markdown_formatting(text: str) -> str:
     if not text:
         return text
-    text = re.sub(r"\\([_*\[\]()~`>#+\-=|{}.!])", r"\1", text)
-    for token in ("**", "__", "`", "*", "_"):
-        text = text.replace(token, "")
-    return text
+    return _MDV2_UNESCAPE_RE.sub(r"\1", text).translate(_MARKDOWN_STRIP_TABLE)
 
 
-async def safe_send_message(bot_or_message, chat_id: int = None, text: str = "", **kwargs):
-    """Safely send a message, falling back to plain text if markdown fails"""
-    if Config.PLAIN_TEXT_OUTPUT:
-        kwargs.pop('parse_mode', None)
-        text = strip_markdown_formatting(text)
+async def _deliver_markdown(send, text: str, kwargs: dict):
+    """Send with the requested parse_mode, falling back to plain text if markdown fails"""
     try:
-        if hasattr(bot_or_message, 'send_message'):
-            return await bot_or_message.send_message(chat_id=chat_id, text=text, **kwargs)
-        else:
-            return await bot_or_message.answer(text=text, **kwargs)
+        return await send(text=text, **kwargs)
     except TelegramBadRequest as e:
         if "can't parse entities" in str(e).lower():
             kwargs.pop('parse_mode', None)
-            text = strip_markdown_formatting(text)
-            if hasattr(bot_or_message, 'send_message'):
-                return await bot_or_message.send_message(chat_id=chat_id, text=text, **kwargs)
-            else:
-                return await bot_or_message.answer(text=text, **kwargs)
-        else:
-            raise
+            return await send(text=strip_markdown_formatting(text), **kwargs)
+        raise
+
+
+async def _deliver_plain(send, text: str, kwargs: dict):
+    """Send as plain text (PLAIN_TEXT_OUTPUT)"""
+    kwargs.pop('parse_mode', None)
+    return await send(text=strip_markdown_formatting(text), **kwargs)
+
+
+# PLAIN_TEXT_OUTPUT задаётся окружением и не меняется во время работы —
+# выбираем реализацию один раз вместо проверки флага на каждой отправке
+_deliver = _deliver_plain if Config.PLAIN_TEXT_OUTPUT else _deliver_markdown
+
+
+# Пользователи, которым бот уже смог написать в личку: для них не нужна
+# пробная отправка перед анализом. Забываем пользователя, как только личка
+# ответила TelegramForbiddenError (бот заблокирован)
+_dm_open: set[int] = set()
+
+
+async def safe_send(bot: Bot, chat_id: int, text: str, **kwargs):
+    """Safely send a message to a chat via the bot"""
+    try:
+        result = await _deliver(functools.partial(bot.send_message, chat_id=chat_id), text, kwargs)
+    except TelegramForbiddenError:
+        _dm_open.discard(chat_id)
+        raise
+    if chat_id > 0:
+        _dm_open.add(chat_id)
+    return result
+
+
+async def safe_answer(message: Message, text: str, **kwargs):
+    """Safely reply to a message in its chat"""
+    return await _deliver(message.answer, text, kwargs)
+
+
+async def replace_progress(progress_msg: Message, text: str, **kwargs):
+    """
+    Превращает «Анализирую...» в группе в следующее сообщение для того же чата:
+    одно редактирование вместо удаления и новой отправки
+    """
+    if await safe_edit_message(progress_msg, text, **kwargs) is None:
+        await safe_send(get_bot(), progress_msg.chat.id, text, **kwargs)
+
+
+async def send_replacing_progress(progress_msg: Message, text: str, **kwargs):
+    """
+    Отправляет итог в личку новым сообщением и удаляет «Анализирую...».
+    Правка сообщения приходит без уведомления, а в личке пользователь обычно не смотрит в чат.
+    """
+    await safe_send(get_bot(), progress_msg.chat.id, text, **kwargs)
+    with contextlib.suppress(TelegramBadRequest):
+        await progress_msg.delete()
+
+
+async def send_private_result(thinking_msg: Message, user_id: int, text: str, confirmation: str):
+    """
+    Отправляет отчёт в личку, затем заменяет «Анализирую...» подтверждением.
+    Подтверждение появляется только после отправки: если личка закрыта, оно было бы ложным.
+    """
+    await safe_send(get_bot(), user_id, text, parse_mode='Markdown')
+    await replace_progress(thinking_msg, confirmation)
 
 
 async def safe_edit_message(message, text: str, **kwargs):
     """Safely edit a message"""
-    if Config.PLAIN_TEXT_OUTPUT:
-        kwargs.pop('parse_mode', None)
-        text = strip_markdown_formatting(text)
     try:
-        return await message.edit_text(text=text, **kwargs)
+        return await _deliver(message.edit_text, text, kwargs)
     except TelegramBadRequest as e:
         if "message to edit not found" in str(e).lower():
             return None
-        elif "can't parse entities" in str(e).lower():
-            kwargs.pop('parse_mode', None)
-            text = strip_markdown_formatting(text)
-            return await message.edit_text(text=text, **kwargs)
-        else:
-            raise
+        raise
+
+
+# ✅ Тип чата проверяется фильтрами роутеров: неподходящий обработчик
+# даже не вызывается
+PRIVATE_CHAT = F.chat.type == ChatType.PRIVATE
+GROUP_CHAT = F.chat.type != ChatType.PRIVATE
+GROUP_ONLY_COMMANDS = (
+    "add_user", "remove_user", "list_users", "clear_memory",
+    "chat_stats", "my_communication", "analyze_user",
+)
+
+
+@dataclass(frozen=True, slots=True)
+class ChatReport:
+    """Групповой отчёт: откуда брать сообщения, чем анализировать и как ответить"""
+    load: Callable[[MessageCache, int], List[Dict[str, Any]]]
+    analyze: str  # имя метода CommunicationAnalyzer
+    empty_msg: str
+    progress_msg: str
+    template: str
+
+
+CHAT_REPORTS = {
+    "conflict": ChatReport(
+        load=lambda cache, chat_id: cache.get_last_n_messages(chat_id, 100),
+        analyze="analyze_conflict",
+        empty_msg="not_enough_messages",
+        progress_msg="analyzing_conflict",
+        template="conflict_template",
+    ),
+    "digest": ChatReport(
+        load=lambda cache, chat_id: cache.get_messages_since(chat_id, datetime.now() - LAST_24H),
+        analyze="analyze_tips",
+        empty_msg="no_messages_24h",
+        progress_msg="collecting_tips",
+        template="digest_template",
+    ),
+}
 
 
 def _register_handlers(dp: Dispatcher):
     """Регистрируем все обработчики команд"""
-
-    @dp.message(CommandStart())
+    # Фильтр роутера проверяется один раз на сообщение, а не в каждом обработчике
+    private = Router(name="private_chat")
+    private.message.filter(PRIVATE_CHAT)
+    group = Router(name="group_chat")
+    group.message.filter(GROUP_CHAT, F.from_user)
+    dp.include_routers(private, group)
+
+    @private.message(CommandStart())
     async def start_command(message: Message):
-        if message.chat.type != ChatType.PRIVATE:
-            return
-        await safe_send_message(message, text=Config.MESSAGES["welcome_text"], parse_mode='Markdown')
+        await safe_answer(message, MSG["welcome_text"], parse_mode='Markdown')
 
-    @dp.message(Command("help"))
+    @private.message(Command("help"))
     async def help_command(message: Message):
-        if message.chat.type != ChatType.PRIVATE:
-            return
-        help_text = Config.MESSAGES["help_text_template"].format(rate_limit=Config.RATE_LIMIT_SECONDS)
-        await safe_send_message(message, text=help_text, parse_mode='Markdown')
+        await safe_answer(message, HELP_TEXT, parse_mode='Markdown')
 
-    @dp.message(Command("analyze_last_100"))
+    @group.message(Command("analyze_last_100"))
     async def analyze_last_100(message: Message):
         await handle_analysis_command(message, "last_100")
 
-    @dp.message(Command("analyze_last_24h"))
+    @group.message(Command("analyze_last_24h"))
     async def analyze_last_24h(message: Message):
         await handle_analysis_command(message, "last_24h")
 
-    @dp.message(Command("add_user"))
-    async def add_user_command(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer(Config.MESSAGES["private_chat_only"])
-            return
-        if not message.from_user:
-            return
+    @group.message(Command("add_user"))
+    async def add_user_command(message: Message, command: CommandObject):
         user_id = message.from_user.id
         if not is_main_admin(user_id):
-            await message.answer(Config.MESSAGES["main_admin_only_add"])
+            await message.answer(MSG["main_admin_only_add"])
             return
         if message.reply_to_message and message.reply_to_message.from_user:
             target_user = message.reply_to_message.from_user
             new_user_id = target_user.id
-            username = target_user.username or target_user.first_name or Config.MESSAGES["default_username"]
+            username = target_user.username or target_user.first_name or MSG["default_username"]
             if add_authorized_user(new_user_id):
-                await message.answer(Config.MESSAGES["user_added"].format(username=username, user_id=new_user_id))
+                await message.answer(MSG["user_added"].format(username=username, user_id=new_user_id))
             else:
-                await message.answer(Config.MESSAGES["user_already_added"].format(username=username, user_id=new_user_id))
+                await message.answer(MSG["user_already_added"].format(username=username, user_id=new_user_id))
             return
         try:
-            command_parts = (message.text or "").split()
-            if len(command_parts) != 2:
-                await message.answer(Config.MESSAGES["add_user_usage"])
+            user_input = (command.args or "").strip()
+            if not user_input or " " in user_input:
+                await message.answer(MSG["add_user_usage"])
                 return
-            user_input = command_parts[1]
             if user_input.startswith('@'):
                 username = user_input[1:]
                 try:
                     chat_member = await get_bot().get_chat_member(message.chat.id, username)
                     new_user_id = chat_member.user.id
                     if add_authorized_user(new_user_id):
-                        await message.answer(Config.MESSAGES["user_added"].format(username=username, user_id=new_user_id))
+                        await message.answer(MSG["user_added"].format(username=username, user_id=new_user_id))
                     else:
-                        await message.answer(Config.MESSAGES["user_already_added"].format(username=username, user_id=new_user_id))
+                        await message.answer(MSG["user_already_added"].format(username=username, user_id=new_user_id))
                 except Exception as e:
-                    await message.answer(Config.MESSAGES["user_not_found"].format(username=username))
+                    await message.answer(MSG["user_not_found"].format(username=username))
                     logger.error(f"Error finding user @{username}: {e}")
             else:
                 new_user_id = int(user_input)
                 if add_authorized_user(new_user_id):
-                    await message.answer(Config.MESSAGES["user_added_by_id"].format(user_id=new_user_id))
+                    await message.answer(MSG["user_added_by_id"].format(user_id=new_user_id))
                 else:
-                    await message.answer(Config.MESSAGES["user_already_added_by_id"].format(user_id=new_user_id))
+                    await message.answer(MSG["user_already_added_by_id"].format(user_id=new_user_id))
         except ValueError:
-            await message.answer(Config.MESSAGES["invalid_format"])
+            await message.answer(MSG["invalid_format"])
         except Exception as e:
-            await message.answer(Config.MESSAGES["error_adding_user"].format(error=str(e)))
+            await message.answer(MSG["error_adding_user"].format(error=str(e)))
 
-    @dp.message(Command("remove_user"))
-    async def remove_user_command(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer(Config.MESSAGES["private_chat_only"])
-            return
-        if not message.from_user:
-            return
+    @group.message(Command("remove_user"))
+    async def remove_user_command(message: Message, command: CommandObject):
         user_id = message.from_user.id
         if not is_main_admin(user_id):
-            await message.answer(Config.MESSAGES["main_admin_only_remove"])
+            await message.answer(MSG["main_admin_only_remove"])
             return
         if message.reply_to_message and message.reply_to_message.from_user:
             target_user = message.reply_to_message.from_user
             target_user_id = target_user.id
-            username = target_user.username or target_user.first_name or Config.MESSAGES["default_username"]
+            username = target_user.username or target_user.first_name or MSG["default_username"]
             if remove_authorized_user(target_user_id):
-                await message.answer(Config.MESSAGES["user_removed"].format(username=username, user_id=target_user_id))
+                await message.answer(MSG["user_removed"].format(username=username, user_id=target_user_id))
             else:
-                await message.answer(Config.MESSAGES["user_cannot_remove"].format(username=username))
+                await message.answer(MSG["user_cannot_remove"].format(username=username))
             return
         try:
-            command_parts = (message.text or "").split()
-            if len(command_parts) != 2:
-                await message.answer(Config.MESSAGES["remove_user_usage"])
+            user_input = (command.args or "").strip()
+            if not user_input or " " in user_input:
+                await message.answer(MSG["remove_user_usage"])
                 return
-            user_input = command_parts[1]
             if user_input.startswith('@'):
                 username = user_input[1:]
                 try:
                     chat_member = await get_bot().get_chat_member(message.chat.id, username)
                     target_user_id = chat_member.user.id
                     if remove_authorized_user(target_user_id):
-                        await message.answer(Config.MESSAGES["user_removed"].format(username=username, user_id=target_user_id))
+                        await message.answer(MSG["user_removed"].format(username=username, user_id=target_user_id))
                     else:
-                        await message.answer(Config.MESSAGES["user_cannot_remove_by_id"].format(username=username, user_id=target_user_id))
+                        await message.answer(MSG["user_cannot_remove_by_id"].format(username=username, user_id=target_user_id))
                 except Exception as e:
-                    await message.answer(Config.MESSAGES["user_not_found"].format(username=username))
+                    await message.answer(MSG["user_not_found"].format(username=username))
             else:
                 target_user_id = int(user_input)
                 if remove_authorized_user(target_user_id):
-                    await message.answer(Config.MESSAGES["user_removed_by_id"].format(user_id=target_user_id))
+                    await message.answer(MSG["user_removed_by_id"].format(user_id=target_user_id))
                 else:
-                    await message.answer(Config.MESSAGES["user_cannot_remove_by_id"].format(username="", user_id=target_user_id))
+                    await message.answer(MSG["user_cannot_remove_by_id"].format(username="", user_id=target_user_id))
         except ValueError:
-            await message.answer(Config.MESSAGES["invalid_format"])
+            await message.answer(MSG["invalid_format"])
         except Exception as e:
-            await message.answer(Config.MESSAGES["error_removing_user"].format(error=str(e)))
+            await message.answer(MSG["error_removing_user"].format(error=str(e)))
 
-    @dp.message(Command("list_users"))
+    @group.message(Command("list_users"))
     async def list_users_command(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer(Config.MESSAGES["private_chat_only"])
-            return
-        if not message.from_user:
-            return
         if not is_main_admin(message.from_user.id):
-            await message.answer(Config.MESSAGES["main_admin_only_list"])
+            await message.answer(MSG["main_admin_only_list"])
             return
         if not Config.AUTHORIZED_USERS:
-            await message.answer(Config.MESSAGES["user_list_empty"])
+            await message.answer(MSG["user_list_empty"])
             return
-        user_list = ""
-        for i, uid in enumerate(Config.AUTHORIZED_USERS):
-            role = Config.MESSAGES["main_admin_role"] if i == 0 else ""
-            user_list += Config.MESSAGES["user_list_item"].format(user_id=uid, role=role)
-        await safe_send_message(message, text=Config.MESSAGES["user_list_template"].format(user_list=user_list), parse_mode='Markdown')
+        user_list = "".join(
+            MSG["user_list_item"].format(
+                user_id=uid,
+                role=MSG["main_admin_role"] if is_main_admin(uid) else "",
+            )
+            for uid in sorted(Config.AUTHORIZED_USERS, key=lambda uid: (not is_main_admin(uid), uid))
+        )
+        await safe_answer(message, MSG["user_list_template"].format(user_list=user_list), parse_mode='Markdown')
 
-    @dp.message(Command("clear_memory"))
+    @group.message(Command("clear_memory"))
     async def clear_memory_command(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer(Config.MESSAGES["private_chat_only"])
-            return
-        if not message.from_user:
-            return
         if not is_main_admin(message.from_user.id):
-            await message.answer(Config.MESSAGES["main_admin_only_clear"])
+            await message.answer(MSG["main_admin_only_clear"])
             return
-        cache = get_message_cache()
-        before = cache.get_memory_usage_stats()
-        cache.clear_old_messages_from_memory()
-        after = cache.get_memory_usage_stats()
-        cleared = before['total_messages_in_memory'] - after['total_messages_in_memory']
-        stats_text = Config.MESSAGES["memory_cleared_template"].format(
+        cache = await fresh_message_cache()
+        stats = cache.clear_old_messages_from_memory()
+        before, after, cleared = stats['before'], stats['after'], stats['cleared']
+        stats_text = MSG["memory_cleared_template"].format(
             before_messages=before['total_messages_in_memory'],
             before_chats=before['total_chats_in_memory'],
             after_messages=after['total_messages_in_memory'],
@@ -311,32 +565,27 @@ def _register_handlers(dp: Dispatcher):
             cleared_messages=cleared,
             freed_memory=cleared * 0.5
         )
-        await safe_send_message(message, text=stats_text, parse_mode='Markdown')
+        await safe_answer(message, stats_text, parse_mode='Markdown')
 
-    @dp.message(Command("chat_stats"))
+    @group.message(Command("chat_stats"))
     async def chat_stats_command(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer(Config.MESSAGES["private_chat_only"])
-            return
-        if not message.from_user:
-            return
         if not is_user_authorized(message.from_user.id):
-            await message.answer(Config.MESSAGES["not_authorized"])
+            await message.answer(MSG["not_authorized"])
             return
-        cache = get_message_cache()
+        cache = await fresh_message_cache()
         chat_id = message.chat.id
         cache_stats = cache.get_chat_stats(chat_id)
         memory_stats = cache.get_memory_usage_stats()
-        oldest_message = cache_stats['oldest_message'].strftime('%Y-%m-%d %H:%M') if cache_stats['oldest_message'] else Config.MESSAGES["no_messages"]
-        newest_message = cache_stats['newest_message'].strftime('%Y-%m-%d %H:%M') if cache_stats['newest_message'] else Config.MESSAGES["no_messages"]
+        oldest_message = cache_stats['oldest_message'].isoformat(sep=' ', timespec='minutes') if cache_stats['oldest_message'] else MSG["no_messages"]
+        newest_message = cache_stats['newest_message'].isoformat(sep=' ', timespec='minutes') if cache_stats['newest_message'] else MSG["no_messages"]
         if cache_stats['total_messages'] == 0:
-            warning_message = Config.MESSAGES["empty_cache_warning"]
+            warning_message = MSG["empty_cache_warning"]
         elif cache_stats['total_messages'] < 10:
-            warning_message = Config.MESSAGES["low_messages_warning"]
+            warning_message = MSG["low_messages_warning"]
         else:
             warning_message = ""
-        stats_text = Config.MESSAGES["chat_stats_template"].format(
-            chat_title=message.chat.title,
+        stats_text = MSG["chat_stats_template"].format(
+            chat_title=escape_markdown(message.chat.title),
             total_messages=cache_stats['total_messages'],
             memory_messages=len(cache.chats.get(chat_id, [])),
             unique_users=cache_stats['unique_users'],
@@ -348,330 +597,278 @@ def _register_handlers(dp: Dispatcher):
             total_chats_in_memory=memory_stats['total_chats_in_memory'],
             warning_message=warning_message
         )
-        await safe_send_message(message, text=stats_text, parse_mode='Markdown')
+        await safe_answer(message, stats_text, parse_mode='Markdown')
 
-    @dp.message(Command("my_communication"))
+    @group.message(Command("my_communication"))
     async def my_communication_command(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer(Config.MESSAGES["private_chat_only"])
-            return
-        if not message.from_user:
-            return
         user_id = message.from_user.id
         chat_id = message.chat.id
-        username = message.from_user.username or message.from_user.first_name or "Пользователь"
+        username = message.from_user.username or message.from_user.first_name or MSG["default_username"]
         if not is_user_authorized(user_id):
-            await message.answer(Config.MESSAGES["not_authorized"])
+            await message.answer(MSG["not_authorized"])
             return
         if not check_rate_limit(user_id):
-            await message.answer(Config.MESSAGES["rate_limit"].format(rate_limit=Config.RATE_LIMIT_SECONDS))
+            await message.answer(RATE_LIMIT_MSG)
             return
-        thinking_msg = await message.answer(Config.MESSAGES["analyzing_communication"])
+        thinking_msg = await message.answer(MSG["analyzing_communication"])
         try:
-            cache = get_message_cache()
+            cache = await fresh_message_cache()
             user_messages = cache.get_user_messages(chat_id, user_id)
             interactions = cache.get_user_interactions(chat_id, user_id)
             if not user_messages:
-                await safe_edit_message(thinking_msg, Config.MESSAGES["no_messages_for_analysis"])
+                await safe_edit_message(thinking_msg, MSG["no_messages_for_analysis"])
                 return
-            analysis_result = await get_ai_analyzer().analyze_user_communication(user_messages, interactions, username)
-            await thinking_msg.delete()
-            await safe_send_message(get_bot(), chat_id=user_id, text=analysis_result, parse_mode='Markdown')
-            await message.answer(Config.MESSAGES["analysis_sent_private"].format(username=username))
+            async with analysis_slot(message.chat.id):
+                analysis_result = await get_ai_analyzer().analyze_user_communication(user_messages, interactions, username)
+            await send_private_result(thinking_msg, user_id, analysis_result,
+                                      MSG["analysis_sent_private"].format(username=username))
         except Exception as e:
-            await safe_edit_message(thinking_msg, Config.MESSAGES["analysis_error"].format(error=str(e)))
+            await safe_edit_message(thinking_msg, MSG["analysis_error"].format(error=str(e)))
             logger.error(f"Personal analysis error: {e}")
 
-    @dp.message(Command("analyze_user"))
-    async def analyze_user_command(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer(Config.MESSAGES["private_chat_only"])
-            return
-        if not message.from_user:
-            return
+    @group.message(Command("analyze_user"))
+    async def analyze_user_command(message: Message, command: CommandObject):
         user_id = message.from_user.id
         chat_id = message.chat.id
         if not is_user_authorized(user_id):
-            await message.answer(Config.MESSAGES["not_authorized"])
+            await message.answer(MSG["not_authorized"])
             return
         if not check_rate_limit(user_id):
-            await message.answer(Config.MESSAGES["rate_limit"].format(rate_limit=Config.RATE_LIMIT_SECONDS))
+            await message.answer(RATE_LIMIT_MSG)
             return
         target_user_id = None
         target_username = None
         if message.reply_to_message and message.reply_to_message.from_user:
             target_user_id = message.reply_to_message.from_user.id
-            target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or Config.MESSAGES["default_username"]
+            target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or MSG["default_username"]
         else:
-            command_parts = (message.text or "").split()
-            if len(command_parts) < 2:
-                await message.answer(Config.MESSAGES["analyze_user_usage"])
+            user_input = (command.args or "").strip()
+            if not user_input:
+                await message.answer(MSG["analyze_user_usage"])
                 return
-            user_input = command_parts[1]
             if user_input.startswith('@'):
                 username = user_input[1:]
-                cache = get_message_cache()
-                all_messages = cache.get_last_n_messages(chat_id, 1000)
-                for msg in all_messages:
-                    if msg.get('username', '').lower() == username.lower():
-                        target_user_id = msg['user_id']
-                        target_username = msg['username']
-                        break
+                found = (await fresh_message_cache()).find_user_by_username(username, chat_id)
+                if found:
+                    target_user_id, target_username = found
                 if not target_user_id:
-                    await message.answer(f"❌ Пользователь @{username} не найден в кеше сообщений.")
+                    await message.answer(MSG["user_not_in_cache"].format(username=username))
                     return
             else:
-                await message.answer("❌ Неверный формат. Используйте @username.")
+                await message.answer(MSG["username_required"])
                 return
         if not target_user_id:
-            await message.answer("❌ Не удалось определить пользователя для анализа.")
+            await message.answer(MSG["analysis_target_unknown"])
             return
-        thinking_msg = await message.answer(f"🤔 Анализирую стиль коммуникации {target_username}...")
+        thinking_msg = await message.answer(MSG["analyzing_user_style"].format(username=target_username))
         try:
-            cache = get_message_cache()
+            cache = await fresh_message_cache()
             user_messages = cache.get_user_messages(chat_id, target_user_id)
             interactions = cache.get_user_interactions(chat_id, target_user_id)
             if not user_messages:
-                await safe_edit_message(thinking_msg, f"❌ Нет сообщений от {target_username}.")
+                await safe_edit_message(thinking_msg, MSG["no_user_messages"].format(username=target_username))
                 return
-            analysis_result = await get_ai_analyzer().analyze_user_communication(user_messages, interactions, target_username)
-            await thinking_msg.delete()
-            await safe_send_message(get_bot(), chat_id=user_id, text=analysis_result, parse_mode='Markdown')
-            await message.answer(f"✅ Анализ {target_username} отправлен в личные сообщения.")
+            async with analysis_slot(message.chat.id):
+                analysis_result = await get_ai_analyzer().analyze_user_communication(user_messages, interactions, target_username)
+            await send_private_result(thinking_msg, user_id, analysis_result,
+                                      MSG["user_analysis_sent_private"].format(username=target_username))
         except Exception as e:
-            await safe_edit_message(thinking_msg, f"❌ Ошибка при анализе: {str(e)}")
+            await safe_edit_message(thinking_msg, MSG["analysis_error"].format(error=str(e)))
             logger.error(f"User analysis error: {e}")
 
-    @dp.message(Command("analyze_user_all"))
-    async def analyze_user_all_command(message: Message):
-        if not message.from_user:
-            return
+    @dp.message(Command("analyze_user_all"), F.from_user)
+    async def analyze_user_all_command(message: Message, command: CommandObject):
         user_id = message.from_user.id
         is_private_chat = message.chat.type == ChatType.PRIVATE
         if not is_user_authorized(user_id):
-            await message.answer("❌ У вас нет прав для использования этой команды.")
+            await message.answer(MSG["not_authorized"])
             return
         if not check_rate_limit(user_id):
-            await message.answer(f"⏱️ Подождите {Config.RATE_LIMIT_SECONDS} секунд.")
+            await message.answer(RATE_LIMIT_SHORT_MSG)
             return
         target_user_id = None
         target_username = None
         if not is_private_chat and message.reply_to_message and message.reply_to_message.from_user:
             target_user_id = message.reply_to_message.from_user.id
-            target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or "Пользователь"
+            target_username = message.reply_to_message.from_user.username or message.reply_to_message.from_user.first_name or MSG["default_username"]
         else:
-            command_parts = (message.text or "").split()
-            if len(command_parts) < 2:
-                await message.answer("❌ Использование: /analyze_user_all @username или <user_id>")
+            user_input = (command.args or "").strip()
+            if not user_input:
+                await message.answer(MSG["analyze_user_all_usage"])
                 return
-            user_input = command_parts[1]
-            cache = get_message_cache()
-            if user_input.startswith('@'):
-                username = user_input[1:]
-                for cid in cache.get_all_chats():
-                    all_messages = cache.get_last_n_messages(cid, 1000)
-                    for msg in all_messages:
-                        if msg.get('username', '').lower() == username.lower():
-                            target_user_id = msg['user_id']
-                            target_username = msg['username']
-                            break
-                    if target_user_id:
-                        break
-                if not target_user_id:
-                    await message.answer(f"❌ Пользователь @{username} не найден.")
-                    return
-            elif user_input.isdigit():
-                target_user_id = int(user_input)
-                for cid in cache.get_all_chats():
-                    for msg in cache.get_last_n_messages(cid, 1000):
-                        if msg.get('user_id') == target_user_id:
-                            target_username = msg.get('username', f"User_{target_user_id}")
-                            break
-                    if target_username:
-                        break
-                if not target_username:
-                    target_username = f"User_{target_user_id}"
-            else:
-                await message.answer("❌ Неверный формат.")
+            if not (user_input.startswith('@') or user_input.isdigit()):
+                await message.answer(MSG["invalid_format_short"])
+                return
+            found = (await fresh_message_cache()).resolve_user(user_input)
+            if not found:
+                await message.answer(MSG["user_not_found_anywhere"].format(username=user_input[1:]))
                 return
-        thinking_msg = await message.answer("🤔 Анализирую стиль коммуникации из всех чатов...")
+            target_user_id, target_username = found
+            if not target_username:
+                target_username = MSG["default_username_id"].format(user_id=target_user_id)
+        thinking_msg = await message.answer(MSG["analyzing_user_style_all_chats"])
         try:
-            cache = get_message_cache()
+            cache = await fresh_message_cache()
             user_messages = cache.get_user_messages_all_chats(target_user_id)
             interactions = cache.get_user_interactions_all_chats(target_user_id)
             user_stats = cache.get_user_chat_stats(target_user_id)
             if not user_messages:
-                await thinking_msg.edit_text(f"❌ Нет сообщений от {target_username} ни в одном чате.")
+                await thinking_msg.edit_text(MSG["no_user_messages_all_chats"].format(username=target_username))
                 return
-            analysis_result = await get_ai_analyzer().analyze_user_communication(user_messages, interactions, target_username)
-            stats_summary = (
-                f"\n\n📊 *Статистика по всем чатам:*\n"
-                f"• Всего сообщений: {user_stats['total_messages']}\n"
-                f"• Чатов с активностью: {user_stats['chats_count']}\n"
-            )
+            async with analysis_slot(message.chat.id):
+                analysis_result = await get_ai_analyzer().analyze_user_communication(user_messages, interactions, target_username)
+            period_info = ""
             if user_stats['oldest_message'] and user_stats['newest_message']:
-                stats_summary += (
-                    f"• Период: {user_stats['oldest_message'].strftime('%Y-%m-%d')} - "
-                    f"{user_stats['newest_message'].strftime('%Y-%m-%d')}\n"
+                period_info = MSG["period_info_template"].format(
+                    oldest_date=user_stats['oldest_message'].date().isoformat(),
+                    newest_date=user_stats['newest_message'].date().isoformat(),
                 )
+            stats_summary = MSG["cross_chat_stats_template"].format(
+                total_messages=user_stats['total_messages'],
+                chats_count=user_stats['chats_count'],
+                period_info=period_info,
+            )
             full_analysis = analysis_result + stats_summary
-            await thinking_msg.delete()
             if is_private_chat:
-                await safe_send_message(message, text=full_analysis, parse_mode='Markdown')
+                await send_replacing_progress(thinking_msg, full_analysis, parse_mode='Markdown')
             else:
-                await safe_send_message(get_bot(), chat_id=user_id, text=full_analysis, parse_mode='Markdown')
-                await message.answer(f"✅ Анализ {target_username} из всех чатов отправлен в личные сообщения.")
+                await send_private_result(thinking_msg, user_id, full_analysis,
+                                          MSG["user_analysis_all_sent_private"].format(username=target_username))
         except Exception as e:
-            await safe_edit_message(thinking_msg, f"❌ Ошибка: {str(e)}")
+            await safe_edit_message(thinking_msg, MSG["analysis_error_short"].format(error=str(e)))
             logger.error(f"Cross-chat analysis error: {e}")
 
-    @dp.message(Command("conflict"))
-    async def cmd_conflict(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer("❌ Эта команда работает только в групповых чатах.")
+    @group.message(Command(*CHAT_REPORTS))
+    async def chat_report_command(message: Message, command: CommandObject):
+        report = CHAT_REPORTS[command.command]
+        if not check_rate_limit(message.from_user.id):
+            await message.answer(RATE_LIMIT_MSG)
             return
-        if not message.from_user:
-            return
-        user_id = message.from_user.id
-        chat_id = message.chat.id
-        if not check_rate_limit(user_id):
-            await message.answer(Config.MESSAGES["rate_limit"].format(rate_limit=Config.RATE_LIMIT_SECONDS))
-            return
-        messages = get_message_cache().get_last_n_messages(chat_id, 100)
+        messages = report.load(await fresh_message_cache(), message.chat.id)
         if not messages:
-            await message.answer("❌ Недостаточно сообщений.")
+            await message.answer(MSG[report.empty_msg])
             return
-        thinking_msg = await message.answer("🔍 Анализирую конфликт... ⏳")
+        thinking_msg = await message.answer(MSG[report.progress_msg])
         try:
-            analysis = await get_ai_analyzer().analyze_conflict(messages)
-            await thinking_msg.delete()
-            await safe_send_message(message, text=f"📝 *Анализ конфликта:*\n\n{analysis}", parse_mode='Markdown')
+            async with analysis_slot(message.chat.id):
+                result = await getattr(get_ai_analyzer(), report.analyze)(messages)
+            await replace_progress(thinking_msg, MSG[report.template].format(report=result), parse_mode='Markdown')
         except Exception as e:
-            await safe_edit_message(thinking_msg, f"❌ Ошибка: {str(e)}")
-            logger.error(f"Conflict analysis error: {e}")
+            await safe_edit_message(thinking_msg, MSG["analysis_error_short"].format(error=str(e)))
+            logger.error(f"/{command.command} analysis error: {e}")
 
-    @dp.message(Command("digest"))
-    async def cmd_digest(message: Message):
-        if message.chat.type == ChatType.PRIVATE:
-            await message.answer("❌ Эта команда работает только в групповых чатах.")
-            return
-        if not message.from_user:
-            return
-        user_id = message.from_user.id
-        chat_id = message.chat.id
-        if not check_rate_limit(user_id):
-            await message.answer(Config.MESSAGES["rate_limit"].format(rate_limit=Config.RATE_LIMIT_SECONDS))
-            return
-        since = datetime.now() - timedelta(hours=24)
-        messages = get_message_cache().get_messages_since(chat_id, since)
-        if not messages:
-            await message.answer("❌ За последние 24 часа не было сообщений.")
-            return
-        thinking_msg = await message.answer("🔍 Собираю советы за 24 часа... ⏳")
-        try:
-            tips = await get_ai_analyzer().analyze_tips(messages)
-            await thinking_msg.delete()
-            await safe_send_message(message, text=f"💡 *Дайджест советов:*\n\n{tips}", parse_mode='Markdown')
-        except Exception as e:
-            await safe_edit_message(thinking_msg, f"❌ Ошибка: {str(e)}")
-            logger.error(f"Tips analysis error: {e}")
+    # Групповые команды, отправленные в личку: групповой роутер их не принимает
+    @private.message(Command(*GROUP_ONLY_COMMANDS))
+    async def group_only_command_in_private(message: Message):
+        await message.answer(MSG["private_chat_only"])
+
+    @private.message(Command(*CHAT_REPORTS))
+    async def group_analysis_command_in_private(message: Message):
+        await message.answer(MSG["private_chat_only"])
 
-    @dp.message(F.text & F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
+    @private.message(Command("analyze_last_100", "analyze_last_24h"))
+    async def chat_analysis_command_in_private(message: Message):
+        await message.answer(MSG["analysis_group_only"])
+
+    @group.message(F.text & ~F.text.startswith('/'), F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
     async def cache_group_message(message: Message):
-        if message.text and message.text.startswith('/'):
-            return
-        if not message.from_user or not message.text:
-            return
-        get_message_cache().add_message(
+        ingest_message(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
-            username=message.from_user.username or message.from_user.first_name or "Пользователь",
+            username=message.from_user.username or message.from_user.first_name or MSG["default_username"],
             text=message.text,
             timestamp=datetime.now()
         )
 
 
 async def handle_analysis_command(message: Message, analysis_type: str):
-    """Общая логика для команд анализа"""
-    if message.chat.type == ChatType.PRIVATE:
-        await message.answer("Команды анализа работают только в групповых чатах.")
-        return
-    if not message.from_user:
-        return
+    """Общая логика для команд анализа (тип чата и автор проверены фильтрами)"""
     user_id = message.from_user.id
     chat_id = message.chat.id
     if not is_user_authorized(user_id):
-        await message.answer("❌ У вас нет прав для использования этой команды.")
+        await message.answer(MSG["not_authorized"])
         return
-    if not check_rate_limit(user_id):
-        await message.answer(f"⏱ Подождите {Config.RATE_LIMIT_SECONDS} секунд.")
+    if not check_rate_limit(user_id, cost=Config.RATE_LIMIT_ANALYSIS_COST):
+        await message.answer(WAIT_MSG)
         return
-    cache = get_message_cache()
+    cache = await fresh_message_cache()
     if analysis_type == "last_100":
         messages = cache.get_last_n_messages(chat_id, 100)
-        analysis_description = "последних 100 сообщений"
+        analysis_description = MSG["last_100_description"]
     elif analysis_type == "last_24h":
-        messages = cache.get_messages_since(chat_id, datetime.now() - timedelta(hours=24))
-        analysis_description = "сообщений за последние 24 часа"
+        messages = cache.get_messages_since(chat_id, datetime.now() - LAST_24H)
+        analysis_description = MSG["last_24h_description"]
     else:
-        await message.answer("❌ Неизвестный тип анализа.")
+        await message.answer(MSG["unknown_analysis_type"])
         return
     if not messages:
         cache_stats = cache.get_chat_stats(chat_id)
         if cache_stats['total_messages'] == 0:
-            await message.answer(
-                "❌ Нет сообщений для анализа.\n\n"
-                "Бот сохраняет сообщения только после добавления в чат. "
-                "Подождите, пока участники напишут несколько сообщений."
-            )
+            await message.answer(MSG["no_messages_yet"])
         else:
-            await message.answer(
-                f"❌ Недостаточно сообщений для анализа {analysis_description}.\n"
-                f"Всего в кеше: {cache_stats['total_messages']} сообщений."
-            )
+            await message.answer(MSG["not_enough_messages_for"].format(
+                description=analysis_description, total_messages=cache_stats['total_messages']
+            ))
         return
-    await message.answer(
-        f"🔍 Анализирую {analysis_description} ({len(messages)} сообщений). "
-        f"Результат будет отправлен в личные сообщения."
+    announcement = message.answer(
+        MSG["analysis_started"].format(description=analysis_description, count=len(messages))
     )
-    try:
-        await get_bot().send_message(
-            user_id,
-            f"🔄 Анализирую {analysis_description} из чата «{message.chat.title}». Это займёт несколько секунд..."
+    if user_id in _dm_open:
+        # Личка уже открыта — пробное уведомление не нужно. Если с тех пор бота
+        # заблокировали, отправка отчёта получит Forbidden и пользователь будет забыт
+        announced, notified = await announcement, None
+    else:
+        # Сообщение в группу и пробное уведомление в личку независимы — отправляем параллельно
+        announced, notified = await asyncio.gather(
+            announcement,
+            safe_send(
+                get_bot(),
+                user_id,
+                MSG["analysis_dm_probe"].format(description=analysis_description, chat_title=message.chat.title),
+            ),
+            return_exceptions=True,
         )
-    except Exception as e:
-        logger.error(f"Failed to send private notification: {e}")
-        await message.answer("❌ Не удалось отправить сообщение в личку. Сначала напишите боту /start в личных сообщениях.")
+    if isinstance(announced, Exception):
+        logger.warning(f"Failed to announce analysis in chat {chat_id}: {announced}")
+    if isinstance(notified, Exception):
+        logger.error(f"Failed to send private notification: {notified}")
+        await message.answer(MSG["dm_closed"])
         return
     try:
-        analysis_result = await get_ai_analyzer().analyze_messages(messages)
-        await safe_send_message(
-            get_bot(),
-            chat_id=user_id,
-            text=f"📊 *Анализ коммуникаций: {message.chat.title}*\n\n{analysis_result}",
-            parse_mode='Markdown'
-        )
+        async with analysis_slot(message.chat.id):
+            analysis_result = await get_ai_analyzer().analyze_messages(messages)
+        report = MSG["analysis_title_template"].format(
+            chat_title=escape_markdown(message.chat.title), analysis_result=analysis_result)
+        if isinstance(notified, Message):
+            await send_replacing_progress(notified, report, parse_mode='Markdown')
+        else:
+            await safe_send(get_bot(), user_id, report, parse_mode='Markdown')
         logger.info(f"Analysis completed for user {user_id} in chat {chat_id}")
+    except TelegramForbiddenError:
+        # Бот заблокирован (safe_send уже убрал пользователя из _dm_open) — писать в личку бесполезно
+        logger.warning(f"User {user_id} has blocked the bot, analysis not delivered")
+        await message.answer(MSG["dm_closed"])
     except Exception as e:
         logger.error(f"Analysis failed: {e}")
-        await safe_send_message(
-            get_bot(),
-            chat_id=user_id,
-            text="❌ Ошибка при анализе. Попробуйте позже."
-        )
+        try:
+            await safe_send(get_bot(), user_id, MSG["analysis_failed"])
+        except TelegramForbiddenError:
+            await message.answer(MSG["dm_closed"])
 
 
 # ✅ ИСПРАВЛЕНО: функция handle_update теперь использует get_bot() и get_dp()
 async def handle_update(update_data: dict):
     """Обработка webhook-обновления от Telegram"""
-    from aiogram.types import Update
-    update = Update(**update_data)
-    await get_dp().feed_update(get_bot(), update)
+    bot = get_bot()
+    # model_validate разбирает dict напрямую, без распаковки в **kwargs
+    update = Update.model_validate(update_data, context={"bot": bot})
+    await get_dp().feed_update(bot, update)
 
 
 async def main():
-    """Запуск бота в режиме polling (только для локальной разработки)"""
-    logger.info("Запуск бота в режиме polling (локальная разработка)...")
+    """Запуск бота: polling для локальной разработки или собственный webhook-сервер (USE_WEBHOOK)"""
+    mode = "webhook" if Config.USE_WEBHOOK else "polling (локальная разработка)"
+    logger.info(f"Запуск бота в режиме {mode}...")
     
     if not Config.TELEGRAM_BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN не задан!")
@@ -686,14 +883,47 @@ async def main():
     dp = get_dp()
     
     try:
-        await dp.start_polling(bot)
+        async with cache_writer():
+            if Config.USE_WEBHOOK:
+                await run_webhook(bot, dp)
+            else:
+                await dp.start_polling(bot, handle_as_tasks=True)
     except Exception as e:
         logger.error(f"Ошибка запуска бота: {e}")
     finally:
         await bot.session.close()
 
 
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Telegram сам присылает апдейты на наш HTTP-сервер — без холостых запросов polling"""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    if not Config.WEBHOOK_URL:
+        raise RuntimeError("USE_WEBHOOK включён, но WEBHOOK_URL не задан")
+    await bot.set_webhook(
+        Config.WEBHOOK_URL.rstrip("/") + Config.WEBHOOK_PATH,
+        secret_token=Config.WEBHOOK_SECRET,
+        drop_pending_updates=False,
+    )
+    app = web.Application()
+    # handle_in_background: Telegram сразу получает 200, апдейт обрабатывается задачей
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=Config.WEBHOOK_SECRET, handle_in_background=True,
+    ).register(app, path=Config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, Config.WEBHOOK_HOST, Config.WEBHOOK_PORT).start()
+    logger.info(f"Webhook-сервер слушает {Config.WEBHOOK_HOST}:{Config.WEBHOOK_PORT}{Config.WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 if __name__ == "__main__":
-    # Запускаем polling только при локальном запуске
+    # Запускаем polling (или webhook-сервер при USE_WEBHOOK) только при локальном запуске
     # На Vercel этот блок не выполняется — используется webhook через api/webhook.py
-    asyncio.run(main())
+    (uvloop.run if uvloop else asyncio.run)(main())
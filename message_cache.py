@@ -1,13 +1,36 @@
 import logging
 import sqlite3
-from collections import deque, defaultdict
+import sys
+from bisect import bisect_left
+from collections import OrderedDict, deque, defaultdict
+from itertools import islice
+from operator import itemgetter
 from datetime import datetime
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Dict, Iterable, List, Any, Optional, Tuple
 
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+_timestamp_of = itemgetter('timestamp')
+# Сколько последних сообщений чата проверять на дубликат при добавлении
+_DUPLICATE_LOOKBACK = 20
+
+
+class _ChatBuckets(OrderedDict):
+    """chat_id -> deque последних сообщений; давно молчавшие чаты вытесняются (LRU)"""
+
+    def __init__(self, memory_cache_size: int, max_chats: int):
+        super().__init__()
+        self.memory_cache_size = memory_cache_size
+        self.max_chats = max_chats
+
+    def __missing__(self, chat_id: int) -> deque:
+        bucket = self[chat_id] = deque(maxlen=self.memory_cache_size)
+        if len(self) > self.max_chats:
+            self.popitem(last=False)
+        return bucket
+
 
 class MessageCache:
     """Memory-optimized cache for storing chat messages"""
@@ -22,8 +45,10 @@ class MessageCache:
         """
         self.max_size = max_size
         self.memory_cache_size = memory_cache_size
-        # Dictionary of chat_id -> deque of messages (smaller in-memory cache)
-        self.chats: Dict[int, deque] = defaultdict(lambda: deque(maxlen=memory_cache_size))
+        # Dictionary of chat_id -> deque of messages (smaller in-memory cache).
+        # Each deque is bounded by memory_cache_size and the number of chats by MEMORY_MAX_CHATS;
+        # evicted chats are still served from SQLite
+        self.chats: Dict[int, deque] = _ChatBuckets(memory_cache_size, Config.MEMORY_MAX_CHATS)
         
         # Initialize SQLite connection for persistence
         self.db_path = Config.DB_PATH
@@ -40,6 +65,13 @@ class MessageCache:
         
         self.conn.row_factory = sqlite3.Row
         self._init_db()
+
+        # Индексы пользователей: username.casefold() -> {chat_id: (user_id, username)}
+        # и user_id -> последнее имя. Заполняются из БД при первом поиске,
+        # дальше поддерживаются в add_message — поиск @username без сканирования сообщений
+        self._users_by_name: Dict[str, Dict[int, Tuple[int, str]]] = defaultdict(dict)
+        self._names_by_user: Dict[int, str] = {}
+        self._user_index_loaded = False
         logger.info(f"MessageCache initialized with max_size={max_size}, memory_cache_size={memory_cache_size}")
         logger.info(f"SQLite persistence enabled at {self.db_path}")
         
@@ -55,7 +87,7 @@ class MessageCache:
         cur.execute(Config.SQL_QUERIES["create_index_user_time"])
         self.conn.commit()
     
-    def add_message(self, chat_id: int, user_id: int, username: str, text: str, timestamp: datetime):
+    def add_message(self, chat_id: int, user_id: int, username: str, text: str, timestamp: datetime) -> int:
         """
         Add a message to the cache
         
@@ -65,35 +97,101 @@ class MessageCache:
             username: Username or first name
             text: Message text
             timestamp: When the message was sent
+            
+        Returns:
+            Number of messages from this chat now held in memory
+        """
+        message = self._remember(chat_id, user_id, username, text, timestamp)
+        if message is not None:
+            self.persist_messages([message])
+        
+        # deque(maxlen=memory_cache_size) сам вытесняет старые сообщения —
+        # периодическая очистка на каждом 20-м сообщении не нужна
+        in_memory = len(self.chats[chat_id])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Added message to chat {chat_id}: {in_memory} messages in memory")
+        return in_memory
+    
+    def add_messages_bulk(self, messages: Iterable[Tuple[int, int, str, str, datetime]]) -> int:
+        """
+        Add several messages with a single database transaction
+        
+        Args:
+            messages: (chat_id, user_id, username, text, timestamp) tuples in arrival order
+            
+        Returns:
+            Number of messages stored (duplicates are skipped)
         """
+        stored = self.remember_messages(messages)
+        if stored:
+            self.persist_messages(stored)
+        return len(stored)
+    
+    def remember_messages(self, messages: Iterable[Tuple[int, int, str, str, datetime]]) -> List[Dict[str, Any]]:
+        """In-memory half of add_messages_bulk: returns the messages that still need persist_messages"""
+        return [m for m in (self._remember(*args) for args in messages) if m is not None]
+    
+    def _remember(self, chat_id: int, user_id: int, username: str, text: str,
+                  timestamp: datetime) -> Optional[Dict[str, Any]]:
+        """Write a message to the in-memory cache; None if it is a recent duplicate"""
+        chat = self.chats[chat_id]
+        self.chats.move_to_end(chat_id)
+        # Спам и повторно пересланное: тот же текст того же автора только что был в чате
+        if self._is_recent_duplicate(chat, user_id, text, timestamp):
+            logger.debug(f"Skipped duplicate message from user {user_id} in chat {chat_id}")
+            return None
+        
         message = {
             'chat_id': chat_id,
             'user_id': user_id,
-            'username': username,
+            # Имена повторяются из сообщения в сообщение — храним одну копию строки
+            'username': sys.intern(username) if username else username,
             'text': text,
             'timestamp': timestamp
         }
+        chat.append(message)
+        if self._user_index_loaded:
+            self._index_user(chat_id, user_id, message['username'])
+        return message
+    
+    def open_writer_connection(self) -> sqlite3.Connection:
+        """Separate connection for a background writer thread; the caller closes it"""
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+    
+    def persist_messages(self, messages: List[Dict[str, Any]], conn: Optional[sqlite3.Connection] = None):
+        """
+        Insert messages into SQLite and commit once
         
-        # Write-through to in-memory cache
-        self.chats[chat_id].append(message)
-        
-        # Persist to SQLite
+        Args:
+            messages: Messages returned by remember_messages
+            conn: Connection to write with; self.conn if None. A worker thread must pass
+                its own connection from open_writer_connection()
+        """
+        conn = conn or self.conn
         try:
-            cur = self.conn.cursor()
-            cur.execute(
+            conn.executemany(
                 Config.SQL_QUERIES["insert_message"],
-                (chat_id, user_id, username, text, self._ts_to_str(timestamp))
+                [
+                    (m['chat_id'], m['user_id'], m['username'], m['text'], self._ts_to_str(m['timestamp']))
+                    for m in messages
+                ]
             )
-            self.conn.commit()
+            conn.commit()
         except Exception as e:
-            logger.error(f"Failed to persist message to DB: {e}")
-        
-        # Periodically clear old messages from memory to save RAM
-        # Clear every 20 messages to balance performance and memory usage
-        if len(self.chats[chat_id]) % 20 == 0:
-            self.clear_old_messages_from_memory(chat_id)
-        
-        logger.debug(f"Added message to chat {chat_id}: {len(self.chats[chat_id])} messages in memory")
+            logger.error(f"Failed to persist {len(messages)} message(s) to DB: {e}")
+    
+    @staticmethod
+    def _is_recent_duplicate(chat: deque, user_id: int, text: str, timestamp: datetime) -> bool:
+        """Same user and text among the latest in-memory messages within DUPLICATE_WINDOW_SECONDS"""
+        window = Config.DUPLICATE_WINDOW_SECONDS
+        if window <= 0:
+            return False
+        for msg in islice(reversed(chat), _DUPLICATE_LOOKBACK):
+            if (timestamp - msg['timestamp']).total_seconds() > window:
+                break
+            if msg['user_id'] == user_id and msg['text'] == text:
+                return True
+        return False
     
     def get_last_n_messages(self, chat_id: int, n: int) -> List[Dict[str, Any]]:
         """
@@ -124,8 +222,8 @@ class MessageCache:
             if chat_id not in self.chats:
                 logger.warning(f"No messages found for chat {chat_id}")
                 return []
-            messages = list(self.chats[chat_id])
-            return messages[-n:] if len(messages) >= n else messages
+            chat = self.chats[chat_id]
+            return list(islice(chat, max(len(chat) - n, 0), None))
     
     def get_messages_since(self, chat_id: int, since_time: datetime) -> List[Dict[str, Any]]:
         """
@@ -153,7 +251,10 @@ class MessageCache:
             if chat_id not in self.chats:
                 logger.warning(f"No messages found for chat {chat_id}")
                 return []
-            return [m for m in self.chats[chat_id] if m['timestamp'] >= since_time]
+            # Сообщения в памяти упорядочены по времени: находим начало бинарным поиском
+            chat = self.chats[chat_id]
+            start = bisect_left(chat, since_time, key=_timestamp_of)
+            return list(islice(chat, start, None))
     
     def get_chat_stats(self, chat_id: int) -> Dict[str, Any]:
         """
@@ -167,14 +268,13 @@ class MessageCache:
         """
         try:
             cur = self.conn.cursor()
-            cur.execute(Config.SQL_QUERIES["get_chat_stats_count"], (chat_id,))
+            # Один проход по индексу чата вместо двух запросов
+            cur.execute(Config.SQL_QUERIES["get_chat_stats"], (chat_id,))
             row = cur.fetchone()
-            cur.execute(Config.SQL_QUERIES["get_chat_stats_users"], (chat_id,))
-            row2 = cur.fetchone()
             total = int(row["cnt"]) if row and row["cnt"] is not None else 0
             oldest_ts = self._str_to_ts(row["oldest"]) if row and row["oldest"] else None
             newest_ts = self._str_to_ts(row["newest"]) if row and row["newest"] else None
-            unique_users = int(row2["users"]) if row2 and row2["users"] is not None else 0
+            unique_users = int(row["users"]) if row and row["users"] is not None else 0
             return {
                 'total_messages': total,
                 'unique_users': unique_users,
@@ -500,53 +600,129 @@ class MessageCache:
                 stats['newest_message'] = all_user_messages[-1]['timestamp']
             return stats
 
+    def find_user_by_username(self, username: str, chat_id: Optional[int] = None) -> Optional[Tuple[int, str]]:
+        """
+        Find a user by username (case-insensitive, Unicode casefold)
+
+        Args:
+            username: Username without the leading @
+            chat_id: Restrict the search to this chat; any chat if None
+
+        Returns:
+            (user_id, username as stored) or None if the user is unknown
+        """
+        self._ensure_user_index()
+        hits = self._users_by_name.get(username.casefold())
+        if not hits:
+            return None
+        if chat_id is not None:
+            return hits.get(chat_id)
+        return next(reversed(hits.values()))
+
+    def resolve_user(self, identifier: str, chat_id: Optional[int] = None) -> Optional[Tuple[int, Optional[str]]]:
+        """
+        Resolve a command argument to a user
+
+        Args:
+            identifier: "@username" or a numeric user ID
+            chat_id: Restrict @username lookup to this chat; any chat if None
+
+        Returns:
+            (user_id, latest known username or None), or None if @username is unknown
+            or the identifier has neither form
+        """
+        if identifier.startswith('@'):
+            return self.find_user_by_username(identifier[1:], chat_id)
+        if identifier.isdigit():
+            user_id = int(identifier)
+            return user_id, self.get_username(user_id)
+        return None
+
+    def get_username(self, user_id: int) -> Optional[str]:
+        """Latest known username for a user ID, or None"""
+        self._ensure_user_index()
+        return self._names_by_user.get(user_id)
+
+    def _index_user(self, chat_id: int, user_id: int, username: Optional[str]):
+        if not username:
+            return
+        hits = self._users_by_name[username.casefold()]
+        # Перемещаем в конец: последний написавший с этим именем находится первым
+        hits.pop(chat_id, None)
+        hits[chat_id] = (user_id, username)
+        self._names_by_user[user_id] = username
+
+    def _ensure_user_index(self):
+        """Build the user index from persisted messages once per process"""
+        if self._user_index_loaded:
+            return
+        try:
+            cur = self.conn.cursor()
+            cur.execute(Config.SQL_QUERIES["get_known_users"])
+            for row in cur:
+                username = row["username"]
+                self._index_user(row["chat_id"], row["user_id"], sys.intern(username) if username else None)
+        except Exception as e:
+            logger.error(f"DB error while building user index: {e}")
+            # Fallback: index whatever is still in memory
+            for messages in self.chats.values():
+                for msg in messages:
+                    self._index_user(msg['chat_id'], msg['user_id'], msg['username'])
+        self._user_index_loaded = True
+
     def _row_to_message(self, row: sqlite3.Row) -> Dict[str, Any]:
         return {
             'chat_id': int(row['chat_id']),
             'user_id': int(row['user_id']),
-            'username': row['username'],
+            'username': sys.intern(row['username']) if row['username'] else row['username'],
             'text': row['text'],
             'timestamp': self._str_to_ts(row['timestamp'])
         }
 
     def _ts_to_str(self, ts: datetime) -> str:
-        # Use ISO format for lexical ordering compatibility
-        return ts.strftime('%Y-%m-%d %H:%M:%S')
+        # Use ISO format for lexical ordering compatibility; isoformat is the
+        # C fast path for the same '%Y-%m-%d %H:%M:%S' layout on naive datetimes
+        return ts.isoformat(sep=' ', timespec='seconds')
 
     def _str_to_ts(self, s: str) -> datetime:
-        # Parse ISO-like string
+        # fromisoformat разбирает '%Y-%m-%d %H:%M:%S' без разбора шаблона strptime
         try:
-            return datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
+            return datetime.fromisoformat(s)
         except Exception:
-            # Fallback to datetime.fromisoformat if possible
-            try:
-                return datetime.fromisoformat(s)
-            except Exception:
-                # Last resort: return current time to avoid crashes
-                logger.error(f"Failed to parse timestamp: {s}")
-                return datetime.now()
+            # Last resort: return current time to avoid crashes
+            logger.error(f"Failed to parse timestamp: {s}")
+            return datetime.now()
     
-    def clear_old_messages_from_memory(self, chat_id: int = None):
+    def clear_old_messages_from_memory(self, chat_id: int = None) -> Dict[str, Any]:
         """
         Clear old messages from memory cache to free up RAM
         
         Args:
             chat_id: Specific chat to clear, or None to clear all chats
+            
+        Returns:
+            Dictionary with 'before'/'after' memory stats (same keys as
+            get_memory_usage_stats) and the number of 'cleared' messages
         """
-        if chat_id is not None:
-            if chat_id in self.chats:
-                # Keep only the most recent messages in memory
-                recent_messages = list(self.chats[chat_id])[-self.memory_cache_size:]
-                self.chats[chat_id].clear()
-                self.chats[chat_id].extend(recent_messages)
-                logger.debug(f"Cleared old messages from memory for chat {chat_id}, kept {len(recent_messages)} recent messages")
-        else:
-            # Clear all chats
-            for cid in list(self.chats.keys()):
-                recent_messages = list(self.chats[cid])[-self.memory_cache_size:]
-                self.chats[cid].clear()
-                self.chats[cid].extend(recent_messages)
-                logger.debug(f"Cleared old messages from memory for chat {cid}, kept {len(recent_messages)} recent messages")
+        total_before = sum(len(chat) for chat in self.chats.values())
+        cleared = 0
+        chat_ids = [chat_id] if chat_id is not None else list(self.chats.keys())
+        for cid in chat_ids:
+            if cid not in self.chats:
+                continue
+            chat = self.chats[cid]
+            # Keep only the most recent messages in memory
+            excess = len(chat) - self.memory_cache_size
+            for _ in range(max(excess, 0)):
+                chat.popleft()
+            cleared += max(excess, 0)
+            logger.debug(f"Cleared old messages from memory for chat {cid}, kept {len(chat)} recent messages")
+        total_chats = len(self.chats)
+        return {
+            'before': {'total_messages_in_memory': total_before, 'total_chats_in_memory': total_chats},
+            'after': {'total_messages_in_memory': total_before - cleared, 'total_chats_in_memory': total_chats},
+            'cleared': cleared,
+        }
     
     def get_memory_usage_stats(self) -> Dict[str, Any]:
         """
@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+
+class TokenBucket:
+    """Per-user token bucket for command rate limiting"""
+
+    def __init__(self, capacity: float, refill_seconds: float, max_users: int = 10_000):
+        """
+        Initialize token bucket
+
+        Args:
+            capacity: Maximum number of tokens a user can accumulate (burst size)
+            refill_seconds: Seconds needed to refill one token
+            max_users: Number of users to track; least recently active are evicted
+        """
+        self.capacity = capacity
+        # 0 секунд — лимит отключён: ведро сразу наполняется заново
+        self.rate = 1.0 / refill_seconds if refill_seconds > 0 else None
+        self.max_users = max_users
+        # user_id -> [tokens, last_refill]; OrderedDict даёт LRU-вытеснение
+        self._buckets: "OrderedDict[int, list]" = OrderedDict()
+
+    def try_acquire(self, user_id: int, cost: float = 1.0, now: Optional[float] = None) -> bool:
+        """
+        Take `cost` tokens from the user's bucket
+
+        Args:
+            user_id: Telegram user ID
+            cost: Tokens the action costs; capped at capacity so it is always reachable
+            now: time.monotonic() value, taken automatically if None
+
+        Returns:
+            True if the action is allowed, False if the user must wait
+        """
+        if now is None:
+            now = time.monotonic()
+        cost = min(cost, self.capacity)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            # Новый пользователь начинает с полным ведром
+            bucket = self._buckets[user_id] = [self.capacity, now]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            self._drop_idle(now)
+            if self.rate is None:
+                bucket[0] = self.capacity
+            else:
+                bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
+
+    def _drop_idle(self, now: float):
+        """Evict the least recently active user if their bucket has fully refilled"""
+        # Полное ведро ничем не отличается от отсутствующей записи — её можно забыть.
+        # Текущий пользователь уже перенесён в конец, поэтому при len > 1 не вытесняется.
+        if len(self._buckets) < 2:
+            return
+        oldest = next(iter(self._buckets.values()))
+        if self.rate is None or (now - oldest[1]) * self.rate >= self.capacity:
+            self._buckets.popitem(last=False)
+
+    def refund(self, user_id: int, cost: float = 1.0):
+        """Return tokens taken by try_acquire when a later check rejected the action"""
+        bucket = self._buckets.get(user_id)
+        if bucket is not None:
+            bucket[0] = min(self.capacity, bucket[0] + min(cost, self.capacity))
+
+    def clear(self):
+        self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class SlidingWindowLimiter:
+    """Per-user sliding window: at most `limit` actions in any `window_seconds`"""
+
+    def __init__(self, limit: int, window_seconds: float, max_users: int = 10_000):
+        """
+        Initialize sliding window limiter
+
+        Args:
+            limit: Maximum number of actions inside the window
+            window_seconds: Window length in seconds
+            max_users: Number of users to track; least recently active are evicted
+        """
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.max_users = max_users
+        # user_id -> deque времён принятых действий, не длиннее limit
+        self._hits: "OrderedDict[int, deque]" = OrderedDict()
+
+    def try_acquire(self, user_id: int, now: Optional[float] = None) -> bool:
+        """Record an action if the window has room; single pass over expired hits"""
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.window_seconds
+        hits = self._hits.get(user_id)
+        if hits is None:
+            hits = self._hits[user_id] = deque()
+            if len(self._hits) > self.max_users:
+                self._hits.popitem(last=False)
+        else:
+            self._hits.move_to_end(user_id)
+            # Самый давний пользователь без действий в окне — запись можно забыть
+            if len(self._hits) > 1:
+                oldest = next(iter(self._hits.values()))
+                if not oldest or oldest[-1] <= cutoff:
+                    self._hits.popitem(last=False)
+        while hits and hits[0] <= cutoff:
+            hits.popleft()
+        if len(hits) >= self.limit:
+            return False
+        hits.append(now)
+        return True
+
+    def refund(self, user_id: int):
+        """Forget the latest action recorded by try_acquire"""
+        hits = self._hits.get(user_id)
+        if hits:
+            hits.pop()
+
+    def clear(self):
+        self._hits.clear()
+
+    def __len__(self) -> int:
+        return len(self._hits)
+
+
+class AsyncTokenBucket:
+    """Shared token bucket that delays callers instead of rejecting them (outgoing API calls)"""
+
+    def __init__(self, capacity: float, refill_seconds: float):
+        """
+        Initialize async token bucket
+
+        Args:
+            capacity: Calls allowed back-to-back after idling (burst size)
+            refill_seconds: Seconds needed to refill one token
+        """
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        # Время, к которому освободится следующий токен (GCRA): одна float-переменная
+        # вместо счётчика токенов, очередь ожидающих образуется сама собой
+        self._next_free = 0.0
+
+    def reserve(self, now: Optional[float] = None) -> float:
+        """Book a token and return how many seconds the caller has to wait for it"""
+        if now is None:
+            now = time.monotonic()
+        next_free = max(self._next_free, now)
+        delay = max(0.0, next_free - now - self.refill_seconds * (self.capacity - 1))
+        self._next_free = next_free + self.refill_seconds
+        return delay
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
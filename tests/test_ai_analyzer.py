@@ -97,3 +97,469 @@ async def test_analyze_user_communication_formats_output(monkeypatch):
     assert "Персональный анализ" in result
     assert "7/10" in result
 
+
+
+def test_get_model_reuses_instances(monkeypatch):
+    import ai_analyzer
+
+    created = []
+
+    class DummyModel:
+        def __init__(self, model_name, system_instruction, safety_settings):
+            created.append(system_instruction)
+
+    monkeypatch.setattr(ai_analyzer.genai, "GenerativeModel", DummyModel)
+    analyzer = CommunicationAnalyzer()
+
+    first = analyzer._get_model("prompt A")
+    assert analyzer._get_model("prompt A") is first
+    analyzer._get_model("prompt B")
+    assert created == ["prompt A", "prompt B"]
+
+
+def test_prompt_cache_lru_eviction():
+    from ai_analyzer import PromptCache
+
+    cache = PromptCache(max_size=2)
+    k1 = PromptCache.make_key("sys", "a", 0.4)
+    k2 = PromptCache.make_key("sys", "b", 0.4)
+    k3 = PromptCache.make_key("sys", "c", 0.4)
+    assert k1 != k2
+
+    cache.put(k1, "one")
+    cache.put(k2, "two")
+    assert cache.get(k1) == "one"  # k1 becomes most recently used
+    cache.put(k3, "three")
+    assert cache.get(k2) is None
+    assert cache.get(k1) == "one"
+    assert len(cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_analyze_all_formats_once_and_collects_reports(monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "MIN_MESSAGES_FOR_ANALYSIS", 1)
+    analyzer = CommunicationAnalyzer()
+    calls = []
+
+    def fake_format(messages):
+        calls.append(len(messages))
+        return "formatted"
+
+    async def fake_call(system_prompt, user_prompt, temperature=0.4, max_tokens=3000,
+                        response_json=True, stream=False, scope=None):
+        assert "formatted" in user_prompt
+        if response_json:
+            return json.dumps({"communication_tone": "ровный"})
+        return "текст"
+
+    original_select = analyzer._select_window
+    selects = []
+
+    def counting_select(messages):
+        selects.append(len(messages))
+        return original_select(messages)
+
+    monkeypatch.setattr(analyzer, "_format_messages", fake_format)
+    monkeypatch.setattr(analyzer, "_select_window", counting_select)
+    monkeypatch.setattr(analyzer, "_call_gemini", fake_call)
+
+    messages = [{"username": "u1", "text": "hello", "timestamp": datetime(2024, 1, 1, 12, 0, 0)}]
+    reports = await analyzer.analyze_all(messages)
+
+    # The window is selected and formatted once for all three reports
+    assert selects == [1]
+    assert calls == [1]
+    assert set(reports) == {"analysis", "conflict", "tips"}
+    assert "ровный" in reports["analysis"]
+    assert reports["tips"] == "текст"
+
+
+@pytest.mark.asyncio
+async def test_generate_streamed_stops_on_non_json():
+    class Chunk:
+        def __init__(self, text):
+            self.text = text
+
+    consumed = []
+
+    class StreamingModel:
+        async def generate_content_async(self, prompt, generation_config, stream):
+            assert stream is True
+
+            async def chunks():
+                try:
+                    for piece in ("Sorry, ", "I can't", " help"):
+                        consumed.append(piece)
+                        yield Chunk(piece)
+                finally:
+                    consumed.append("closed")
+
+            return chunks()
+
+    _, text = await CommunicationAnalyzer._generate_streamed(StreamingModel(), "p", {}, True)
+    assert text == "Sorry, "
+    # The stream is closed right away when reading stops early
+    assert consumed == ["Sorry, ", "closed"]
+
+    _, text = await CommunicationAnalyzer._generate_streamed(StreamingModel(), "p", {}, False)
+    assert text == "Sorry, I can't help"
+
+    class PlainIterator:
+        """Async iterator without aclose"""
+
+        def __init__(self):
+            self._pieces = iter(["{", "}"])
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            try:
+                return Chunk(next(self._pieces))
+            except StopIteration:
+                raise StopAsyncIteration
+
+    class PlainModel:
+        async def generate_content_async(self, prompt, generation_config, stream):
+            return PlainIterator()
+
+    _, text = await CommunicationAnalyzer._generate_streamed(PlainModel(), "p", {}, True)
+    assert text == "{}"
+
+
+def test_trim_to_token_budget_keeps_latest_messages(monkeypatch):
+    import ai_analyzer
+    from config import Config
+
+    analyzer = CommunicationAnalyzer()
+    messages = [
+        {"username": "u", "text": "x" * 100, "timestamp": datetime(2024, 1, 1, 12, i, 0)}
+        for i in range(10)
+    ]
+    line = ai_analyzer._LINE_OVERHEAD + 1 + 100
+    monkeypatch.setattr(Config, "MAX_INPUT_TOKENS", (3 * line) // ai_analyzer._CHARS_PER_TOKEN + 1)
+
+    trimmed = analyzer._trim_to_token_budget(messages)
+    assert trimmed == messages[-3:]
+
+    monkeypatch.setattr(Config, "MAX_INPUT_TOKENS", 10**6)
+    assert analyzer._trim_to_token_budget(messages) is messages
+
+
+@pytest.mark.asyncio
+async def test_call_gemini_coalesces_concurrent_identical_requests(monkeypatch):
+    import asyncio
+    from config import Config
+
+    monkeypatch.setattr(Config, "GEMINI_API_KEY", "test-key")
+    analyzer = CommunicationAnalyzer()
+    calls = []
+
+    async def fake_request(cache_key, system_prompt, user_prompt, *args):
+        calls.append(user_prompt)
+        await asyncio.sleep(0)
+        return f"answer:{user_prompt}"
+
+    monkeypatch.setattr(analyzer, "_request_gemini", fake_request)
+
+    results = await asyncio.gather(
+        analyzer._call_gemini("sys", "same"),
+        analyzer._call_gemini("sys", "same"),
+        analyzer._call_gemini("sys", "other"),
+    )
+    assert results == ["answer:same", "answer:same", "answer:other"]
+    assert calls == ["same", "other"]
+    assert analyzer._inflight == {}
+
+
+def test_adaptive_max_tokens_scales_with_message_count():
+    from ai_analyzer import _adaptive_max_tokens
+
+    assert _adaptive_max_tokens(3000, 0) == 1536
+    assert _adaptive_max_tokens(3000, 10) == 1792
+    assert _adaptive_max_tokens(3000, 1000) == 3000
+
+
+@pytest.mark.asyncio
+async def test_call_spec_keeps_full_limit_for_json_reports(monkeypatch):
+    from ai_analyzer import AnalysisKind, _ANALYZER_SPECS
+
+    analyzer = CommunicationAnalyzer()
+    limits = {}
+
+    async def fake_call(system_prompt, user_prompt, temperature=0.4, max_tokens=3000,
+                        response_json=True, stream=False, scope=None):
+        limits[user_prompt] = max_tokens
+        return "{}"
+
+    monkeypatch.setattr(analyzer, "_call_gemini", fake_call)
+    await analyzer._call_spec(AnalysisKind.GROUP, "group", message_count=10)
+    await analyzer._call_spec(AnalysisKind.CONFLICT, "conflict", message_count=10)
+
+    assert limits["group"] == _ANALYZER_SPECS[AnalysisKind.GROUP].max_tokens
+    assert limits["conflict"] < _ANALYZER_SPECS[AnalysisKind.CONFLICT].max_tokens
+
+
+@pytest.mark.asyncio
+async def test_context_cache_is_extended_before_recreating(monkeypatch):
+    import ai_analyzer
+    from config import Config
+
+    monkeypatch.setattr(Config, "GEMINI_CONTEXT_CACHE", True)
+    monkeypatch.setattr(Config, "GEMINI_CONTEXT_CACHE_TTL", 0)
+    monkeypatch.setattr(CommunicationAnalyzer, "_context_caches", {})
+    created, updated = [], []
+
+    class FakeCachedContent:
+        def __init__(self, name):
+            self.name = name
+
+        @classmethod
+        def create(cls, model, system_instruction, ttl):
+            created.append(system_instruction)
+            return cls(f"cachedContents/{len(created)}")
+
+        def update(self, ttl):
+            updated.append(self.name)
+
+    monkeypatch.setattr(ai_analyzer.caching, "CachedContent", FakeCachedContent)
+    prompt = "x" * ai_analyzer._CONTEXT_CACHE_MIN_CHARS
+
+    analyzer = CommunicationAnalyzer()
+    assert await analyzer._get_context_cache(prompt) == "cachedContents/1"
+    # With TTL = 0 the next call extends the existing cache instead of creating one
+    assert await CommunicationAnalyzer()._get_context_cache(prompt) == "cachedContents/1"
+    assert created == [prompt]
+    assert updated == ["cachedContents/1"]
+    assert await analyzer._get_context_cache("short") is None
+
+
+def test_similar_prompt_cache_matches_near_duplicate_windows():
+    from ai_analyzer import SimilarPromptCache
+
+    cache = SimilarPromptCache(max_size=4, threshold=0.9, ttl=60)
+    window = "\n".join(f"[2024-01-01 12:{i:02d}] u: message {i}" for i in range(30))
+    cache.put(b"group", window, "report")
+
+    assert cache.get(b"group", window + "\n[2024-01-01 12:30] u: one more") == "report"
+    assert cache.get(b"tips", window) is None
+    assert cache.get(b"group", "\n".join(window.split("\n")[:15])) is None
+
+    disabled = SimilarPromptCache(threshold=0)
+    disabled.put(b"group", window, "report")
+    assert disabled.get(b"group", window) is None
+
+
+def test_similarity_scope_separates_chats_and_users():
+    from ai_analyzer import _similarity_scope
+
+    chat_1 = [{"chat_id": -1, "user_id": 1}, {"chat_id": -1, "user_id": 2}]
+    chat_2 = [{"chat_id": -2, "user_id": 1}]
+
+    assert _similarity_scope(chat_1) == (-1,)
+    assert _similarity_scope(chat_1) != _similarity_scope(chat_2)
+    assert _similarity_scope(chat_2, per_user=True) == ((-2,), (1,))
+    # Without chat_id the similar-prompt cache is skipped entirely
+    assert _similarity_scope([{"user_id": 1}]) is None
+
+
+@pytest.mark.asyncio
+async def test_similar_cache_never_crosses_chats(monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "GEMINI_API_KEY", "test-key")
+    analyzer = CommunicationAnalyzer()
+    analyzer._similar_cache.threshold = 0.9
+    calls = []
+
+    async def fake_request(cache_key, system_prompt, user_prompt, temperature,
+                           max_tokens, response_json, stream, similar_namespace=None):
+        calls.append(user_prompt)
+        report = f"report {len(calls)}"
+        if similar_namespace is not None:
+            analyzer._similar_cache.put(similar_namespace, user_prompt, report)
+        return report
+
+    monkeypatch.setattr(analyzer, "_request_gemini", fake_request)
+    window = "\n".join(f"[2024-01-01 12:{i:02d}] u: message {i}" for i in range(30))
+    longer = window + "\n[2024-01-01 12:30] u: one more"
+
+    assert await analyzer._call_gemini("sys", window, scope=(-1,)) == "report 1"
+    assert await analyzer._call_gemini("sys", longer, scope=(-2,)) == "report 2"
+    assert await analyzer._call_gemini("sys", longer + "\nx", scope=(-1,)) == "report 1"
+    assert len(calls) == 2
+
+
+def test_tail_handles_lists_deques_and_iterators():
+    from collections import deque
+    from ai_analyzer import _tail
+
+    assert _tail([1, 2, 3, 4], 2) == [3, 4]
+    assert _tail((1, 2, 3, 4), 2) == (3, 4)
+    # deque is a Sequence but cannot be sliced
+    assert list(_tail(deque([1, 2, 3, 4]), 2)) == [3, 4]
+    assert list(_tail(deque([1]), 5)) == [1]
+    assert list(_tail(iter(range(5)), 2)) == [3, 4]
+
+
+@pytest.mark.asyncio
+async def test_select_window_keeps_head_and_tail(monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "MAX_MESSAGES_FOR_ANALYSIS", 100)
+    monkeypatch.setattr(Config, "MAX_CHARS_PER_MESSAGE", 10)
+    analyzer = CommunicationAnalyzer()
+    messages = [
+        {"username": "u", "text": f"msg{i}", "timestamp": datetime(2024, 1, 1, 12, 0, 0)}
+        for i in range(250)
+    ]
+
+    window, omitted = analyzer._select_window(messages)
+    assert omitted == 150
+    assert window == messages[:50] + messages[200:]
+    assert analyzer._select_window(messages[:100]) == (messages[:100], 0)
+    assert analyzer._select_window([dict(messages[0], text=" ок ")]) == ([], 0)
+
+    formatted = await analyzer._format_messages_offloaded(window, omitted)
+    lines = formatted.split("\n")
+    assert lines[50] == "... [пропущено сообщений: 150] ..."
+    assert lines[51].endswith(": msg200")
+
+    long_text = [{"username": "u", "text": "abcdefghijklmno", "timestamp": datetime(2024, 1, 1)}]
+    assert analyzer._format_messages(long_text).endswith(": abcdefghij…")
+
+
+@pytest.mark.asyncio
+async def test_analyze_messages_reuses_report_for_unchanged_window(monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "MIN_MESSAGES_FOR_ANALYSIS", 1)
+    analyzer = CommunicationAnalyzer()
+    calls = []
+
+    async def fake_call(system_prompt, user_prompt, temperature=0.4, max_tokens=3000,
+                        response_json=True, stream=False, scope=None):
+        calls.append(user_prompt)
+        return json.dumps({"communication_tone": "ровный"})
+
+    monkeypatch.setattr(analyzer, "_call_gemini", fake_call)
+    messages = [{"username": "u1", "text": "hello", "timestamp": datetime(2024, 1, 1, 12, 0, 0)}]
+
+    first = await analyzer.analyze_messages(messages)
+    assert await analyzer.analyze_messages(list(messages)) == first
+    assert len(calls) == 1
+
+    await analyzer.analyze_messages(messages + [dict(messages[0], text="new message")])
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_analyze_messages_share_one_report(monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "MIN_MESSAGES_FOR_ANALYSIS", 1)
+    import asyncio
+
+    analyzer = CommunicationAnalyzer()
+    formats = []
+    original_format = analyzer._format_messages
+
+    def counting_format(messages):
+        formats.append(len(messages))
+        return original_format(messages)
+
+    async def fake_call(system_prompt, user_prompt, temperature=0.4, max_tokens=3000,
+                        response_json=True, stream=False, scope=None):
+        await asyncio.sleep(0)
+        return json.dumps({"communication_tone": "ровный"})
+
+    monkeypatch.setattr(analyzer, "_format_messages", counting_format)
+    monkeypatch.setattr(analyzer, "_call_gemini", fake_call)
+    messages = [{"username": "u1", "text": "hello", "timestamp": datetime(2024, 1, 1, 12, 0, 0)}]
+
+    first, second = await asyncio.gather(
+        analyzer.analyze_messages(messages),
+        analyzer.analyze_messages(list(messages)),
+    )
+    assert first == second
+    assert formats == [1]
+
+
+@pytest.mark.asyncio
+async def test_conflict_and_tips_reuse_report_for_unchanged_window(monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "MIN_MESSAGES_FOR_ANALYSIS", 1)
+    analyzer = CommunicationAnalyzer()
+    calls = []
+
+    async def fake_call(system_prompt, user_prompt, temperature=0.4, max_tokens=3000,
+                        response_json=True, stream=False, scope=None):
+        calls.append(user_prompt)
+        return "текст"
+
+    monkeypatch.setattr(analyzer, "_call_gemini", fake_call)
+    messages = [{"username": "u1", "text": "hello", "timestamp": datetime(2024, 1, 1, 12, 0, 0)}]
+
+    assert await analyzer.analyze_conflict(messages) == "текст"
+    assert await analyzer.analyze_conflict(list(messages)) == "текст"
+    assert await analyzer.analyze_tips(messages) == "текст"
+    assert await analyzer.analyze_tips(list(messages)) == "текст"
+    # One request per kind: conflict and tips keys never collide
+    assert len(calls) == 2
+
+
+def test_select_window_drops_noise_and_consecutive_repeats():
+    analyzer = CommunicationAnalyzer()
+    ts = datetime(2024, 1, 1, 12, 0, 0)
+    messages = [
+        {"user_id": 1, "username": "u1", "text": "hello there", "timestamp": ts},
+        {"user_id": 1, "username": "u1", "text": "hello there ", "timestamp": ts},
+        {"user_id": 2, "username": "u2", "text": "ok", "timestamp": ts},
+        {"user_id": 2, "username": "u2", "text": "hello there", "timestamp": ts},
+        {"user_id": 1, "username": "u1", "text": "hello there", "timestamp": ts},
+    ]
+
+    window, omitted = analyzer._select_window(messages)
+
+    assert omitted == 0
+    assert [m["user_id"] for m in window] == [1, 2, 1]
+
+
+def test_reports_escape_markdown_in_ai_text():
+    analyzer = CommunicationAnalyzer()
+
+    group = analyzer._format_analysis_report(
+        {"communication_tone": "snake_case *tone*", "recommendations": ["use `code`"]}, 5)
+    assert "snake\\_case \\*tone\\*" in group
+    assert "• use \\`code\\`" in group
+    assert "🎯 *Тон общения:*" in group
+
+    personal = analyzer._format_personal_analysis_report({}, "john_doe", 3)
+    assert "@john\\_doe*" in personal
+
+
+@pytest.mark.asyncio
+async def test_text_reports_keep_model_markdown_and_escape_errors(monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "MIN_MESSAGES_FOR_ANALYSIS", 1)
+    analyzer = CommunicationAnalyzer()
+
+    async def fake_call(system_prompt, user_prompt, temperature=0.4, max_tokens=3000,
+                        response_json=True, stream=False, scope=None):
+        return "*Совет:* говорите _мягче_"
+
+    monkeypatch.setattr(analyzer, "_call_gemini", fake_call)
+    messages = [{"username": "u1", "text": "hello", "timestamp": datetime(2024, 1, 1, 12, 0, 0)}]
+
+    # The model's own formatting is sent as is
+    assert await analyzer.analyze_tips(messages) == "*Совет:* говорите _мягче_"
+
+    def broken_select(messages):
+        raise ValueError("bad_value")
+
+    monkeypatch.setattr(analyzer, "_select_window", broken_select)
+    assert "bad\\_value" in await analyzer.analyze_conflict(messages)
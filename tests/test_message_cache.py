@@ -106,3 +106,121 @@ def test_get_user_interactions(cache):
     partners = set(k for k in interactions.keys() if k != "self")
     assert {"alice", "bob", "carol"}.issubset(partners)
 
+
+
+def test_find_user_by_username(cache):
+    base_time = datetime(2024, 1, 1, 8, 0, 0)
+    cache.add_message(1, 10, "Alice", "hello", base_time)
+    cache.add_message(2, 20, "bob", "hi", base_time)
+
+    assert cache.find_user_by_username("alice") == (10, "Alice")
+    assert cache.find_user_by_username("alice", chat_id=1) == (10, "Alice")
+    assert cache.find_user_by_username("alice", chat_id=2) is None
+    assert cache.get_username(20) == "bob"
+
+    # Index is kept up to date after it has been built
+    cache.add_message(2, 30, "carol", "hey", base_time + timedelta(minutes=1))
+    assert cache.find_user_by_username("CAROL") == (30, "carol")
+    assert cache.find_user_by_username("nobody") is None
+    # First-name fallbacks are matched with Unicode case folding
+    cache.add_message(2, 40, "Straße", "moin", base_time + timedelta(minutes=2))
+    assert cache.find_user_by_username("STRASSE") == (40, "Straße")
+
+    # Command arguments resolve by @username or numeric ID
+    assert cache.resolve_user("@carol") == (30, "carol")
+    assert cache.resolve_user("@alice", chat_id=2) is None
+    assert cache.resolve_user("20") == (20, "bob")
+    assert cache.resolve_user("999") == (999, None)
+    assert cache.resolve_user("carol") is None
+
+    # A fresh cache over the same DB rebuilds the index from persisted rows
+    reopened = MessageCache(max_size=100)
+    try:
+        assert reopened.find_user_by_username("carol", chat_id=2) == (30, "carol")
+        assert reopened.get_username(10) == "Alice"
+    finally:
+        reopened.conn.close()
+
+
+def test_clear_old_messages_from_memory_reports_stats(cache):
+    base = datetime.now() - timedelta(minutes=10)
+    _add_messages(cache, chat_id=1, base_time=base, count=5)
+    _add_messages(cache, chat_id=2, base_time=base, count=2)
+
+    cache.memory_cache_size = 3
+    stats = cache.clear_old_messages_from_memory()
+
+    assert stats["before"] == {"total_messages_in_memory": 7, "total_chats_in_memory": 2}
+    assert stats["after"] == {"total_messages_in_memory": 5, "total_chats_in_memory": 2}
+    assert stats["cleared"] == 2
+    assert [m["text"] for m in cache.chats[1]] == [f"msg {i}" for i in range(2, 5)]
+
+
+def test_memory_keeps_only_most_recently_active_chats(temp_db, monkeypatch):
+    monkeypatch.setattr(Config, "MEMORY_MAX_CHATS", 2)
+    cache = MessageCache(max_size=100)
+    try:
+        base = datetime.now() - timedelta(minutes=10)
+        _add_messages(cache, chat_id=1, base_time=base, count=1)
+        _add_messages(cache, chat_id=2, base_time=base, count=1)
+        _add_messages(cache, chat_id=1, base_time=base, count=1)
+        _add_messages(cache, chat_id=3, base_time=base, count=1)
+
+        assert list(cache.chats) == [1, 3]
+        # Evicted chats are still served from the database
+        assert len(cache.get_last_n_messages(2, 10)) == 1
+    finally:
+        cache.conn.close()
+
+
+def test_get_messages_since_memory_fallback(cache):
+    base = datetime.now() - timedelta(minutes=10)
+    _add_messages(cache, chat_id=1, base_time=base, count=5)
+    # Force the in-memory path
+    cache.conn.close()
+
+    msgs = cache.get_messages_since(1, base + timedelta(minutes=2))
+    assert [m["text"] for m in msgs] == ["msg 2", "msg 3", "msg 4"]
+    assert cache.get_messages_since(1, base + timedelta(minutes=10)) == []
+
+
+def test_add_message_skips_recent_duplicates(cache):
+    now = datetime.now()
+    cache.add_message(chat_id=1, user_id=1, username="u1", text="spam", timestamp=now)
+    cache.add_message(chat_id=1, user_id=1, username="u1", text="spam", timestamp=now + timedelta(seconds=5))
+    # Another author, or the same text after the window, is kept
+    cache.add_message(chat_id=1, user_id=2, username="u2", text="spam", timestamp=now + timedelta(seconds=6))
+    cache.add_message(chat_id=1, user_id=1, username="u1", text="spam", timestamp=now + timedelta(minutes=5))
+
+    assert [m["user_id"] for m in cache.get_last_n_messages(1, 10)] == [1, 2, 1]
+
+
+def test_add_messages_bulk(cache):
+    base_time = datetime(2024, 1, 1, 8, 0, 0)
+    batch = [
+        (1, 10, "alice", "hi", base_time),
+        (1, 10, "alice", "hi", base_time + timedelta(seconds=1)),  # duplicate, skipped
+        (1, 20, "bob", "hello", base_time + timedelta(seconds=2)),
+        (2, 10, "alice", "other chat", base_time + timedelta(seconds=3)),
+    ]
+
+    assert cache.add_messages_bulk(batch) == 3
+    assert [m["text"] for m in cache.get_last_n_messages(1, 10)] == ["hi", "hello"]
+    assert cache.get_chat_stats(2)["total_messages"] == 1
+    assert cache.add_messages_bulk([]) == 0
+
+
+def test_persist_messages_with_writer_connection(cache):
+    import threading
+
+    base_time = datetime(2024, 1, 1, 8, 0, 0)
+    stored = cache.remember_messages([(1, 10, "alice", "hi", base_time)])
+    conn = cache.open_writer_connection()
+    try:
+        writer = threading.Thread(target=cache.persist_messages, args=(stored, conn))
+        writer.start()
+        writer.join()
+    finally:
+        conn.close()
+
+    assert cache.get_chat_stats(1)["total_messages"] == 1
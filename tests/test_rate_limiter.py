@@ -0,0 +1,68 @@
+from rate_limiter import AsyncTokenBucket, SlidingWindowLimiter, TokenBucket
+
+
+def test_token_bucket_allows_burst_then_refills():
+    bucket = TokenBucket(capacity=3, refill_seconds=10)
+
+    assert [bucket.try_acquire(1, now=0.0) for _ in range(4)] == [True, True, True, False]
+    # One token comes back after refill_seconds
+    assert bucket.try_acquire(1, now=9.0) is False
+    assert bucket.try_acquire(1, now=10.5) is True
+    assert bucket.try_acquire(1, now=10.5) is False
+
+
+def test_token_bucket_cost_and_refund():
+    bucket = TokenBucket(capacity=2, refill_seconds=10)
+
+    assert bucket.try_acquire(1, cost=2, now=0.0) is True
+    assert bucket.try_acquire(1, now=0.0) is False
+    bucket.refund(1, cost=2)
+    # Cost above capacity is capped so the action stays reachable
+    assert bucket.try_acquire(1, cost=5, now=0.0) is True
+
+
+def test_token_bucket_users_are_independent_and_bounded():
+    bucket = TokenBucket(capacity=1, refill_seconds=10, max_users=2)
+
+    assert bucket.try_acquire(1, now=0.0) is True
+    assert bucket.try_acquire(2, now=0.0) is True
+    assert bucket.try_acquire(1, now=1.0) is False
+    assert bucket.try_acquire(3, now=1.0) is True
+    assert len(bucket) == 2
+
+
+def test_sliding_window_limits_hits_per_window():
+    window = SlidingWindowLimiter(limit=2, window_seconds=60)
+
+    assert window.try_acquire(1, now=0.0) is True
+    assert window.try_acquire(1, now=30.0) is True
+    assert window.try_acquire(1, now=59.0) is False
+    # The first hit leaves the window, the second still counts
+    assert window.try_acquire(1, now=60.5) is True
+    assert window.try_acquire(1, now=61.0) is False
+    window.refund(1)
+    assert window.try_acquire(1, now=61.0) is True
+
+
+def test_idle_users_are_dropped_opportunistically():
+    bucket = TokenBucket(capacity=1, refill_seconds=10)
+    window = SlidingWindowLimiter(limit=1, window_seconds=60)
+    for limiter in (bucket, window):
+        limiter.try_acquire(1, now=0.0)
+        limiter.try_acquire(2, now=0.0)
+        # User 1 has fully recovered by now, so activity of user 2 forgets them
+        limiter.try_acquire(2, now=100.0)
+        assert len(limiter) == 1
+
+    # The active user is never evicted by their own call
+    assert bucket.try_acquire(2, now=100.0) is False
+    assert window.try_acquire(2, now=100.0) is False
+
+
+def test_async_token_bucket_delays_instead_of_rejecting():
+    bucket = AsyncTokenBucket(capacity=2, refill_seconds=0.5)
+
+    # Burst goes through, then callers queue up one refill interval apart
+    assert [bucket.reserve(now=0.0) for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    # After idling the burst is available again
+    assert bucket.reserve(now=10.0) == 0.0